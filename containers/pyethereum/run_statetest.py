@@ -3,6 +3,7 @@ import sys
 import re
 import os
 import io
+import logging
 from contextlib import redirect_stderr, redirect_stdout
 
 from ethereum.utils import decode_hex, parse_int_or_hex, sha3, to_string, \
@@ -14,6 +15,7 @@ from ethereum.messages import apply_transaction
 from ethereum.config import default_config, config_homestead, config_tangerine, config_spurious, config_metropolis, Env
 import ethereum.tools.new_statetest_utils as new_statetest_utils
 from ethereum.slogging import configure_logging
+from ethereum import slogging
 
 configure_logging(':trace', log_json=True)
 
@@ -59,10 +61,7 @@ def compute_state_test_unit(state, txdata, konfig):
 
 
 
-def runStateTest(test_case, test_transaction):
-    print("running stateTest")
-    pre_state = init_state(test_case['env'], test_case['pre'])
-    #print("inited state:", _state.to_dict())
+def selectConfig(test_case):
     print("pyeth default spurious config")
     test_config = config_spurious
     if test_case['config']['metropolisBlock'] == 0:
@@ -74,11 +73,57 @@ def runStateTest(test_case, test_transaction):
     elif test_case['config']['eip150Block'] != 0 and test_case['config']['homesteadBlock'] == 0:
         print("pyeth setting homestead config")
         test_config = config_homestead
-    computed = compute_state_test_unit(pre_state, test_transaction, test_config)
+    return test_config
+
+
+def runStateTest(test_case, test_transaction):
+    print("running stateTest")
+    pre_state = init_state(test_case['env'], test_case['pre'])
+    #print("inited state:", _state.to_dict())
+    computed = compute_state_test_unit(pre_state, test_transaction, selectConfig(test_case))
     #print("computed:", computed)
 
 
+def serve():
+    """ Server mode: executes one test per line of stdin, each a json request 
+    {"id": .., "prestate": {..}, "prestate_key": .., "tx": {..}}. The output 
+    of each test (the trace and stateRoot) is followed by a delimiter record 
+    {"done": id}, also when the test fails to execute.
+    The "prestate" is left out of requests with the same prestate_key as the
+    request before. The state built for a prestate is kept, and the next request
+    with the same prestate_key runs on it: compute_state_test_unit reverts the 
+    state to its snapshot after each transaction."""
+    # trace and delimiters go to the same stream, so they can't get out of order
+    for handler in slogging.getLogger().handlers:
+        if isinstance(handler, logging.StreamHandler):
+            handler.stream = sys.stdout
+
+    (state_key, state, prestate) = (None, None, None)
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            if 'prestate' in request:
+                (state_key, prestate) = (None, request['prestate'])
+            key = request.get('prestate_key')
+            if key is None or key != state_key:
+                (state_key, state) = (None, init_state(prestate['env'], prestate['pre']))
+            compute_state_test_unit(state, request['tx'], selectConfig(prestate))
+            state_key = key
+        except Exception as e:
+            print("Exception: %r" % e)
+            (state_key, state) = (None, None)
+        print(json.dumps({"done": request_id}))
+        sys.stdout.flush()
+
+
 if __name__ == '__main__':
+    if sys.argv[1:] == ['--server']:
+        serve()
+        sys.exit(0)
     print("statetest.py main.")
     pycmd, test_file, test_tx = sys.argv
     print("test_tx:", test_tx)
@@ -0,0 +1,92 @@
+"""
+Failure buckets: failures are grouped by the `vm.Signature` of their first
+trace difference (opcode, disagreeing clients, error class and diff kind).
+A single bug usually shows up in many tests with the same signature, so
+the full artifacts (saved test, traces and summaries) are only kept for
+the first few failures of each bucket, and the rest are only counted.
+
+The buckets are stored in SQLite, so the processes of a parallel run
+share the counts, and buckets keep filling up across runs:
+
+    python3 -m evmlab.buckets buckets.sqlite
+"""
+import sqlite3, time, argparse
+import logging
+logger = logging.getLogger()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    signature  TEXT PRIMARY KEY,
+    opcode     TEXT NOT NULL,
+    clients    TEXT NOT NULL,
+    error      TEXT NOT NULL,
+    kind       TEXT NOT NULL,
+    count      INTEGER NOT NULL,
+    first_test TEXT,
+    first_seen REAL,
+    last_test  TEXT,
+    last_seen  REAL
+);
+"""
+
+class FailureBuckets(object):
+    """ Counts the failures per signature. A connection must not be shared
+    between processes"""
+
+    def __init__(self, path, keep = 5):
+        self.path = path
+        self.keep = keep
+        self.db = sqlite3.connect(path, timeout = 60, isolation_level = None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def hit(self, signature, test_id):
+        """ Counts a failure. Returns how many failures the bucket has seen,
+        including this one """
+        now = time.time()
+        key = signature.text()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.execute("INSERT OR IGNORE INTO buckets VALUES (?, ?, ?, ?, ?, 0, ?, ?, NULL, NULL)",
+                (key,) + tuple(signature) + (test_id, now))
+            self.db.execute("UPDATE buckets SET count = count + 1, last_test = ?, last_seen = ? WHERE signature = ?",
+                (test_id, now, key))
+            (count,) = self.db.execute("SELECT count FROM buckets WHERE signature = ?", (key,)).fetchone()
+            self.db.execute("COMMIT")
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+        return count
+
+    def keepArtifacts(self, count):
+        """ Whether the artifacts of the count:th failure of a bucket are kept """
+        return self.keep <= 0 or count <= self.keep
+
+    def buckets(self):
+        """ Returns (signature, count, first test, last test) of all buckets, largest first """
+        return self.db.execute("""SELECT signature, count, first_test, last_test FROM buckets
+            ORDER BY count DESC""").fetchall()
+
+    def summary(self, top = 10):
+        rows = self.buckets()
+        lines = ["Failure buckets: %d, with %d failures" % (len(rows), sum(r[1] for r in rows))]
+        for (signature, count, first_test, last_test) in rows[:top]:
+            lines.append("  %6d  %s  (first %s)" % (count, signature, first_test))
+        return lines
+
+    def close(self):
+        self.db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Lists the failure buckets, largest first")
+    parser.add_argument("buckets", type = str, help = "Bucket database")
+    parser.add_argument("--top", type = int, default = 50)
+    options = parser.parse_args()
+
+    buckets = FailureBuckets(options.buckets)
+    print("\n".join(buckets.summary(options.top)))
+    buckets.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+"""
+Coverage-guided test generation.
+
+Random tests mostly exercise the same code paths of the clients over and
+over. A `Campaign` executes every test it hands out on pyethereum, in
+this process (see `pyeth.PyethExecutor`), while tracing which edges
+(pairs of consecutive lines) of pyethereum are hit. Tests which hit new
+edges are kept in a corpus, and new tests are preferably made by mutating
+the corpus entries: changing, inserting (from `randomtest` fragments) or
+deleting code, splicing code from another entry, and changing calldata,
+gas, value and storage. The rest are fresh tests from the generator.
+
+The coverage of pyethereum stands in for that of all clients: a test
+which takes pyethereum down a new path probably does the same with the
+others. With a corpus directory, the corpus survives the campaign, and
+is loaded (and its coverage measured again) when the next one starts.
+"""
+import os, sys, json, copy, random, threading, itertools
+import logging
+logger = logging.getLogger()
+
+from . import pyeth
+
+TEST_NAME = 'randomStatetest'
+
+
+class EdgeCoverage(object):
+    """ Edge coverage of the code in files under the given path prefixes,
+    traced with `sys.settrace` in the calling thread """
+
+    def __init__(self, prefixes):
+        self.prefixes = tuple(prefixes)
+        self.edges = set()
+        self._traced_files = {}
+
+    def _traced(self, filename):
+        traced = self._traced_files.get(filename)
+        if traced is None:
+            traced = self._traced_files[filename] = filename.startswith(self.prefixes)
+        return traced
+
+    def run(self, function, *args):
+        """ Calls the function, returns (its result, the new edges hit) """
+        hit = set()
+
+        def trace_call(frame, event, arg):
+            if not self._traced(frame.f_code.co_filename):
+                return None
+            filename = frame.f_code.co_filename
+            last = [frame.f_lineno]
+
+            def trace_line(frame, event, arg):
+                if event == 'line':
+                    hit.add((filename, last[0], frame.f_lineno))
+                    last[0] = frame.f_lineno
+                return trace_line
+            return trace_line
+
+        previous = sys.gettrace()
+        sys.settrace(trace_call)
+        try:
+            result = function(*args)
+        finally:
+            sys.settrace(previous)
+        new = hit - self.edges
+        self.edges.update(new)
+        return (result, new)
+
+
+class CorpusEntry(object):
+
+    def __init__(self, test, new_edges, path = None):
+        self.test = test
+        self.new_edges = new_edges
+        self.path = path
+        self.picked = 0
+
+    def weight(self):
+        """ Entries which found more new edges, and were mutated less often, are preferred """
+        return (1.0 + self.new_edges) / (1 + self.picked)
+
+
+class Campaign(object):
+    """ Source of tests, which are either mutated corpus entries (with
+    probability 'mutate', once there is a corpus) or fresh tests from the
+    `randomtest.StateTestGenerator`. Thread-safe: the tests are generated
+    and executed one at a time """
+
+    def __init__(self, generator, executor, corpus_dir = None, mutate = 0.8, seed = None):
+        self.generator = generator
+        self.executor = executor
+        self.fork = generator.fork
+        self.corpus_dir = corpus_dir
+        self.mutate = mutate
+        self.rng = random.Random(seed)
+        self.corpus = []
+        self.executions = 0
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+        import ethereum
+        self.coverage = EdgeCoverage([os.path.dirname(os.path.abspath(ethereum.__file__)),
+            os.path.abspath(executor.runner)])
+        if corpus_dir is not None:
+            os.makedirs(corpus_dir, exist_ok = True)
+            self._load()
+
+    def _load(self):
+        for name in sorted(os.listdir(self.corpus_dir)):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.corpus_dir, name)
+            with open(path) as f:
+                test = json.load(f)
+            new = self._execute(test)
+            if new:
+                self.corpus.append(CorpusEntry(test, len(new), path))
+        logger.info("Loaded %d corpus tests from %s, %d edges covered",
+            len(self.corpus), self.corpus_dir, len(self.coverage.edges))
+
+    def _execute(self, test):
+        """ Executes all the post-states of the test, returns the new edges """
+        body = test[TEST_NAME]
+        prestate = { 'env' : body['env'], 'pre' : body['pre'], 'config' : pyeth.forkBlocks(self.fork) }
+        key = "campaign-%d" % next(self.counter)
+        general_tx = body['transaction']
+        new = set()
+        for post in body['post'][self.fork]:
+            indexes = post['indexes']
+            tx = dict(general_tx,
+                data = general_tx['data'][indexes['data']],
+                gasLimit = general_tx['gasLimit'][indexes['gas']],
+                value = general_tx['value'][indexes['value']])
+            try:
+                (lines, edges) = self.coverage.run(self.executor.execute, prestate, tx, None, key)
+            except Exception as e:
+                logger.info("Exception executing campaign test: %s", e)
+                continue
+            new.update(edges)
+            self.executions = self.executions + 1
+        return new
+
+    def _pick(self):
+        total = sum(entry.weight() for entry in self.corpus)
+        r = self.rng.uniform(0, total)
+        for entry in self.corpus:
+            r = r - entry.weight()
+            if r <= 0:
+                break
+        entry.picked = entry.picked + 1
+        return entry
+
+    def next(self):
+        """ Returns the next test, as {'randomStatetest' : test}. The caller gets
+        a copy, so it may change the test without touching the corpus """
+        with self.lock:
+            if self.corpus and self.rng.random() < self.mutate:
+                test = self.mutated(self._pick().test)
+            else:
+                test = self.generator.generate(self.rng.randrange(2**32))
+            new = self._execute(test)
+            if new:
+                self._keep(test, new)
+            return copy.deepcopy(test)
+
+    def _keep(self, test, new):
+        path = None
+        if self.corpus_dir is not None:
+            path = os.path.join(self.corpus_dir, "cov-%06d.json" % len(self.corpus))
+            with open(path, 'w') as f:
+                json.dump(test, f)
+        self.corpus.append(CorpusEntry(test, len(new), path))
+        logger.debug("New coverage: %d edges, corpus of %d tests", len(new), len(self.corpus))
+
+    # Mutations
+
+    def mutated(self, test):
+        """ A copy of the test, with one to three mutations """
+        test = copy.deepcopy(test)
+        body = test[TEST_NAME]
+        mutations = [self._mutateCode, self._mutateCode, self._spliceCode,
+            self._mutateData, self._mutateTx, self._mutateStorage]
+        for i in range(self.rng.randint(1, 3)):
+            self.rng.choice(mutations)(body)
+        body['_info'] = { 'comment' : 'evmlab coverage campaign' }
+        return test
+
+    def _account(self, body):
+        """ An account with code, preferably the one the transaction is sent to """
+        with_code = [a for (a, acc) in body['pre'].items() if len(acc['code']) > 2]
+        to = body['transaction']['to']
+        if to in with_code and (len(with_code) == 1 or self.rng.random() < 0.7):
+            return body['pre'][to]
+        return body['pre'][self.rng.choice(with_code)] if with_code else body['pre'][to]
+
+    def _mutateCode(self, body):
+        rng = self.rng
+        account = self._account(body)
+        code = account['code'][2:]
+        n = len(code) // 2
+        (i, j) = sorted([2 * rng.randint(0, n), 2 * rng.randint(0, n)])
+        r = rng.random()
+        if r < 0.4:
+            # insert new fragments
+            code = code[:i] + self.generator.code(rng, 3) + code[i:]
+        elif r < 0.6:
+            # delete a range
+            code = code[:i] + code[j:]
+        elif r < 0.8 and n:
+            # replace a byte with a random opcode
+            i = min(i, 2 * (n - 1))
+            code = code[:i] + "%02x" % rng.choice(self.generator.ops) + code[i + 2:]
+        else:
+            # duplicate a range
+            code = code[:j] + code[i:j] + code[j:]
+        account['code'] = "0x" + code
+
+    def _spliceCode(self, body):
+        """ Appends code from another corpus entry """
+        other = self.rng.choice(self.corpus).test[TEST_NAME]
+        codes = [acc['code'][2:] for acc in other['pre'].values() if len(acc['code']) > 2]
+        if not codes:
+            return self._mutateCode(body)
+        code = self.rng.choice(codes)
+        n = len(code) // 2
+        (i, j) = sorted([2 * self.rng.randint(0, n), 2 * self.rng.randint(0, n)])
+        account = self._account(body)
+        account['code'] = account['code'] + code[i:j]
+
+    def _mutateData(self, body):
+        rng = self.rng
+        data = body['transaction']['data']
+        k = rng.randrange(len(data))
+        d = data[k][2:]
+        n = len(d) // 2
+        r = rng.random()
+        if r < 0.5 and n:
+            i = 2 * rng.randrange(n)
+            d = d[:i] + "%02x" % rng.randint(0, 255) + d[i + 2:]
+        elif r < 0.75:
+            d = d + "".join("%02x" % rng.randint(0, 255) for i in range(rng.choice([1, 4, 32])))
+        else:
+            d = d[:2 * rng.randint(0, n)]
+        data[k] = "0x" + d
+
+    def _mutateTx(self, body):
+        rng = self.rng
+        tx = body['transaction']
+        if rng.random() < 0.5:
+            k = rng.randrange(len(tx['gasLimit']))
+            tx['gasLimit'][k] = hex(max(21000, int(int(tx['gasLimit'][k], 16) * rng.choice([0.5, 0.9, 1.1, 2]))))
+        else:
+            k = rng.randrange(len(tx['value']))
+            tx['value'][k] = hex(rng.choice([0, 1, 2**16, 10**18]))
+
+    def _mutateStorage(self, body):
+        rng = self.rng
+        account = self._account(body)
+        slot = hex(rng.choice([rng.randint(0, 8), rng.randint(0x100, 0x110)]))
+        if account['storage'] and rng.random() < 0.3:
+            del account['storage'][rng.choice(list(account['storage']))]
+        else:
+            account['storage'][slot] = hex(rng.choice([0, 1, 2**255, 2**256 - 1, rng.getrandbits(64)]))
+
+    def report(self):
+        return "Coverage campaign: %d edges covered, corpus of %d tests, %d executions" % (
+            len(self.coverage.edges), len(self.corpus), self.executions)
@@ -0,0 +1,162 @@
+"""
+Persistent catalog of a state test corpus.
+
+For every test file, the catalog stores its path, mtime, byte size,
+content hash, test name, and the number of post-states per fork. It is
+updated incrementally: only files whose mtime or size changed are read
+(and parsed) again. Selecting, skipping and sharding the tests, as well
+as estimating the cost of a run, work off the catalog without parsing
+any test JSON.
+
+    python3 -m evmlab.catalog catalog.sqlite /ethereum/tests/GeneralStateTests Byzantium
+"""
+import os, sqlite3, hashlib, json, re, zlib, argparse
+import logging
+logger = logging.getLogger()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path    TEXT PRIMARY KEY,
+    mtime   REAL NOT NULL,
+    size    INTEGER NOT NULL,
+    hash    TEXT NOT NULL,
+    name    TEXT,
+    posts   TEXT NOT NULL
+);
+"""
+
+class Entry(object):
+    """ A test file in the catalog. 'posts' maps fork name -> number of post-states """
+
+    def __init__(self, path, mtime, size, hash, name, posts):
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.hash = hash
+        self.name = name
+        self.posts = posts
+
+    @property
+    def subfolder(self):
+        return self.path.split(os.sep)[-2]
+
+    def __repr__(self):
+        return "Entry(%s, %s, %s)" % (self.path, self.name, self.posts)
+
+
+class TestCatalog(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout = 60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def update(self, root):
+        """ Brings the catalog up to date with the test files under 'root'. Only
+        new and modified files are read. Returns (#added or changed, #removed)"""
+        prefix = os.path.join(root, '')
+        known = dict((path, (mtime, size)) for (path, mtime, size) in
+            self.db.execute("SELECT path, mtime, size FROM files WHERE substr(path, 1, ?) = ?", 
+            (len(prefix), prefix)))
+        changed = 0
+        for subdir, dirs, files in os.walk(root):
+            for f in files:
+                if not f.endswith('json'):
+                    continue
+                path = os.path.join(subdir, f)
+                st = os.stat(path)
+                if known.pop(path, None) == (st.st_mtime, st.st_size):
+                    continue
+                self._add(path, st)
+                changed = changed + 1
+        for path in known:
+            self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+        self.db.commit()
+        if changed or known:
+            logger.info("Catalog %s: %d files added or changed, %d removed", self.path, changed, len(known))
+        return (changed, len(known))
+
+    def _add(self, path, st):
+        with open(path, 'rb') as f:
+            data = f.read()
+        name = None
+        posts = {}
+        try:
+            test = json.loads(data.decode())
+            # there should only be one test per file
+            name = list(test.keys())[0]
+            posts = dict((fork, len(p)) for (fork, p) in test[name].get('post', {}).items())
+        except Exception as e:
+            logger.warning("Cannot parse test file %s: %s", path, e)
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+            (path, st.st_mtime, st.st_size, hashlib.sha256(data).hexdigest(), name, json.dumps(posts)))
+
+    def entries(self, root = None):
+        query = "SELECT path, mtime, size, hash, name, posts FROM files"
+        args = ()
+        if root is not None:
+            prefix = os.path.join(root, '')
+            query = query + " WHERE substr(path, 1, ?) = ?"
+            args = (len(prefix), prefix)
+        for (path, mtime, size, hash, name, posts) in self.db.execute(query + " ORDER BY path", args):
+            yield Entry(path, mtime, size, hash, name, json.loads(posts))
+
+    def select(self, fork, root = None, skip = (), skip_patterns = (), whitelist = (),
+            ignore = (), shard = (0, 1)):
+        """ Returns the entries of the test files which have post-states for the fork,
+        minus the skipped ones (by test name, or name pattern), or only the
+        whitelisted ones. With shard (i, n), only the i:th of n disjoint shards
+        is returned, which are stable as long as the paths don't change """
+        skip = set(skip)
+        regex = re.compile('|'.join(skip_patterns)) if skip_patterns else None
+        (shard_i, shard_n) = shard
+        selected = []
+        for entry in self.entries(root):
+            if not entry.posts.get(fork):
+                continue
+            if any(os.path.basename(entry.path).find(i) != -1 for i in ignore):
+                continue
+            if whitelist:
+                if entry.name not in whitelist:
+                    continue
+            elif entry.name in skip or (regex and regex.search(entry.name)):
+                continue
+            if shard_n > 1 and zlib.crc32(entry.path.encode()) % shard_n != shard_i:
+                continue
+            selected.append(entry)
+        return selected
+
+    def cost(self, entries, fork):
+        """ Estimated cost of running the entries: (#tests, total bytes). Each
+        post-state is executed as a single test """
+        return (sum(e.posts.get(fork, 0) for e in entries), sum(e.size for e in entries))
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Updates a test catalog, and shows the cost per fork")
+    parser.add_argument("catalog", type = str, help = "Catalog database")
+    parser.add_argument("root", type = str, help = "Directory of the tests, e.g. /ethereum/tests/GeneralStateTests")
+    parser.add_argument("fork", type = str, nargs = "?", default = None)
+    options = parser.parse_args()
+
+    catalog = TestCatalog(options.catalog)
+    catalog.update(options.root)
+    forks = set()
+    for entry in catalog.entries(options.root):
+        forks.update(entry.posts.keys())
+    for fork in sorted(forks):
+        if options.fork is not None and fork != options.fork:
+            continue
+        entries = catalog.select(fork, options.root)
+        (tests, size) = catalog.cost(entries, fork)
+        print("%-16s %6d files %8d tests %12d bytes" % (fork, len(entries), tests, size))
+    catalog.close()
+
+if __name__ == '__main__':
+    main()
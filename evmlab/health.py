@@ -0,0 +1,147 @@
+"""
+Health of the clients during a run.
+
+The outcome of every trace read from a client is classified as 'ok' (the
+output has the final stateRoot), a 'timeout' (it was cut off by the
+timeout of the client), 'empty' (the client produced no trace at all) or
+a 'crash' (the trace ends early, before the stateRoot). The stateRoot is
+looked for in the raw output, since the canonical trace leaves it out
+for transactions without any EVM steps (e.g. a plain value transfer).
+
+A client which keeps failing, e.g. a broken docker image, would hold up
+every test until its timeout and produce a useless diff each time. After
+'eject_after' consecutive failed traces, `ClientHealth` ejects the client:
+the tests are executed without it, while a background thread probes it
+every 'probe_interval' seconds, and re-admits it once a probe succeeds.
+
+The health is tracked per process, so each process of a parallel run
+ejects (and probes) a client on its own.
+"""
+import time, threading, collections
+import logging
+logger = logging.getLogger()
+
+OK = 'ok'
+CRASH = 'crash'
+TIMEOUT = 'timeout'
+EMPTY = 'empty'
+
+def outcome(steps, complete, seconds, timeout = None):
+    """ Classifies a trace of 'steps' canonical steps, which took 'seconds' to
+    read, 'complete' if it ends with the stateRoot """
+    if complete:
+        return OK
+    if timeout is not None and seconds >= timeout:
+        return TIMEOUT
+    if steps == 0:
+        return EMPTY
+    return CRASH
+
+
+class ClientHealth(object):
+    """ Counts the trace outcomes per client, and ejects a client after
+    'eject_after' consecutive failures (0: never), as long as at least
+    'minimum' other clients remain to compare. An ejected client is probed
+    with 'probe(client)', which returns whether the client works again """
+
+    def __init__(self, clients, eject_after = 0, probe = None, probe_interval = 60, minimum = 2):
+        self.clients = list(clients)
+        self.eject_after = eject_after
+        self.probe = probe
+        self.probe_interval = probe_interval
+        self.minimum = minimum
+        self.counts = collections.defaultdict(collections.Counter)
+        self.consecutive = collections.Counter()
+        self.ejections = collections.Counter()
+        self.ejected_clients = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def record(self, client, result):
+        with self.lock:
+            self.counts[client][result] += 1
+            if client in self.ejected_clients:
+                # a trace started before the ejection, or a probe
+                return
+            if result == OK:
+                self.consecutive[client] = 0
+                return
+            self.consecutive[client] += 1
+            failures = self.consecutive[client]
+            if not self.eject_after or failures < self.eject_after:
+                return
+            remaining = len(self.clients) - len(self.ejected_clients) - 1
+            if remaining < self.minimum:
+                if failures == self.eject_after:
+                    logger.warning("%s failed %d traces in a row, but is not ejected: only %d clients would remain",
+                        client, failures, remaining)
+                return
+            self.ejected_clients.add(client)
+            self.ejections[client] += 1
+
+        logger.warning("Ejecting %s after %d failed traces in a row (last: %s), probing it every %ds",
+            client, failures, result, self.probe_interval)
+        if self.probe is not None:
+            thread = threading.Thread(target = self._probe, args = (client,), name = "probe-%s" % client)
+            thread.daemon = True
+            thread.start()
+
+    def _probe(self, client):
+        while not self.stopped.wait(self.probe_interval):
+            try:
+                healthy = self.probe(client)
+            except Exception as e:
+                logger.info("Exception probing %s: %s", client, e)
+                healthy = False
+            if healthy:
+                with self.lock:
+                    self.ejected_clients.discard(client)
+                    self.consecutive[client] = 0
+                logger.warning("Re-admitting %s, its probe succeeded", client)
+                return
+            logger.info("Probe of %s failed, it stays ejected", client)
+
+    def ejected(self, client):
+        with self.lock:
+            return client in self.ejected_clients
+
+    def admitted(self, clients):
+        """ The clients which are not ejected, in order """
+        with self.lock:
+            return [c for c in clients if c not in self.ejected_clients]
+
+    def monitor(self, client, lines, canonicalizer, timeout = None):
+        """ Yields the canonical trace steps of the output 'lines' of a client.
+        The outcome is recorded once the trace has been read to its end, not if
+        it's closed before """
+        started = time.time()
+        count = 0
+        complete = False
+
+        def watched(lines):
+            nonlocal complete
+            for line in lines:
+                if line.find('"stateRoot"') != -1:
+                    complete = True
+                yield line
+
+        for step in canonicalizer(watched(lines)):
+            count = count + 1
+            yield step
+        self.record(client, outcome(count, complete, time.time() - started, timeout))
+
+    def summary(self):
+        """ Returns the lines of a per-client table of failure rates """
+        lines = ["Client health (crash / timeout / empty trace rates)"]
+        with self.lock:
+            for client in sorted(self.counts):
+                counts = self.counts[client]
+                total = sum(counts.values())
+                rates = " / ".join("%.1f%%" % (100.0 * counts[r] / total) for r in (CRASH, TIMEOUT, EMPTY))
+                ejections = ", ejected %d times" % self.ejections[client] if self.ejections[client] else ""
+                lines.append("  %s: %d traces, %s%s" % (client, total, rates, ejections))
+        return lines
+
+    def stop(self):
+        """ Stops the probes """
+        self.stopped.set()
@@ -0,0 +1,225 @@
+"""
+SQLite-backed ledger of state test runs.
+
+Every executed test is recorded along with the run it belongs to, the
+clients it was executed on, the outcome, timings and the paths of the
+artifacts (saved test, combined trace, summary) kept for failures. The
+resources used by each client (see `vm.Usage`) are recorded per test.
+
+The ledger makes it possible to resume an interrupted run where it left
+off, to re-run only the tests which failed in a previous run, and to
+query the results across runs, e.g.
+
+    python3 -m evmlab.ledger ledger.sqlite runs
+    python3 -m evmlab.ledger ledger.sqlite failures
+    python3 -m evmlab.ledger ledger.sqlite history stExample/foo/2
+    python3 -m evmlab.ledger ledger.sqlite usage
+
+Writes are committed in batches, so recording a test costs next to nothing
+compared with executing it.
+"""
+import os, sqlite3, json, time, argparse
+import logging
+logger = logging.getLogger()
+
+from . import vm as VMUtils
+
+PASS = 'PASS'
+FAIL = 'FAIL'
+ERROR = 'ERROR'
+# a difference which did not reproduce when the test was re-run
+FLAKY = 'FLAKY'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id   INTEGER PRIMARY KEY AUTOINCREMENT,
+    started  REAL NOT NULL,
+    clients  TEXT NOT NULL,
+    fork     TEXT NOT NULL,
+    host     TEXT,
+    config   TEXT
+);
+CREATE TABLE IF NOT EXISTS tests (
+    run_id    INTEGER NOT NULL REFERENCES runs(run_id),
+    test_key  TEXT NOT NULL,
+    test_id   TEXT NOT NULL,
+    clients   TEXT NOT NULL,
+    outcome   TEXT NOT NULL,
+    started   REAL,
+    duration  REAL,
+    artifacts TEXT,
+    reproduced REAL,
+    PRIMARY KEY (run_id, test_key)
+);
+CREATE TABLE IF NOT EXISTS usage (
+    run_id    INTEGER NOT NULL REFERENCES runs(run_id),
+    test_key  TEXT NOT NULL,
+    client    TEXT NOT NULL,
+    wall      REAL,
+    user      REAL,
+    sys       REAL,
+    maxrss    INTEGER
+);
+CREATE INDEX IF NOT EXISTS usage_run ON usage (run_id, client);
+CREATE INDEX IF NOT EXISTS tests_key ON tests (test_key);
+CREATE INDEX IF NOT EXISTS tests_outcome ON tests (run_id, outcome);
+"""
+
+
+class RunLedger(object):
+    """ Run ledger stored in a SQLite database. Tests are identified within a
+    run by their 'test key', which (unlike the test id) does not depend on
+    the position of the test in the run. A ledger must only be written from
+    one process"""
+
+    def __init__(self, path, batch = 100, interval = 5):
+        self.path = path
+        self.batch = batch
+        self.interval = interval
+        self.uncommitted = 0
+        self.last_commit = time.time()
+        self.run_id = None
+        self.db = sqlite3.connect(path, timeout = 60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(tests)")]
+        if 'reproduced' not in columns:
+            # ledgers from before failures were re-run
+            self.db.execute("ALTER TABLE tests ADD COLUMN reproduced REAL")
+        self.db.commit()
+
+    def startRun(self, clients, fork, config = None):
+        """ Starts a new run, which subsequent tests are recorded in """
+        cur = self.db.execute("INSERT INTO runs (started, clients, fork, host, config) VALUES (?, ?, ?, ?, ?)",
+            (time.time(), ",".join(clients), fork, os.uname()[1], json.dumps(config)))
+        self.db.commit()
+        self.run_id = cur.lastrowid
+        logger.info("Recording run %d in ledger %s", self.run_id, self.path)
+        return self.run_id
+
+    def resumeRun(self, clients, fork, config = None):
+        """ Continues the last run, or starts a new one if there is none.
+        Returns the keys of the tests already recorded in the run """
+        run_id = self.lastRun()
+        if run_id is None:
+            self.startRun(clients, fork, config)
+            return set()
+        self.run_id = run_id
+        done = self.testKeys(run_id)
+        logger.info("Resuming run %d from ledger %s, %d tests done", run_id, self.path, len(done))
+        return done
+
+    def record(self, test_key, test_id, clients, outcome, started = None, duration = None, 
+            artifacts = None, usage = None, reproduced = None):
+        """ Records a test. 'usage' is a dict of client name -> `vm.Usage`, and
+        'reproduced' the fraction of re-runs which reproduced a difference """
+        self.db.execute("""INSERT OR REPLACE INTO tests (run_id, test_key, test_id, clients, 
+            outcome, started, duration, artifacts, reproduced) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (self.run_id, test_key, test_id, ",".join(clients), outcome, started, duration,
+            json.dumps(artifacts or []), reproduced))
+        if usage:
+            self.db.executemany("INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(self.run_id, test_key, client) + tuple(u) for (client, u) in usage.items()])
+        self.uncommitted = self.uncommitted + 1
+        if self.uncommitted >= self.batch or time.time() - self.last_commit > self.interval:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+        self.last_commit = time.time()
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+    # Queries
+
+    def lastRun(self):
+        row = self.db.execute("SELECT max(run_id) FROM runs").fetchone()
+        return row[0]
+
+    def previousRun(self):
+        """ The last run before the current one """
+        if self.run_id is None:
+            return self.lastRun()
+        row = self.db.execute("SELECT max(run_id) FROM runs WHERE run_id < ?", (self.run_id,)).fetchone()
+        return row[0]
+
+    def testKeys(self, run_id):
+        return set(r[0] for r in self.db.execute("SELECT test_key FROM tests WHERE run_id = ?", (run_id,)))
+
+    def failures(self, run_id = None):
+        """ Returns (test key, test id, artifacts) of the failed tests of a run
+        (default the last one). Flaky differences are not failures """
+        if run_id is None:
+            run_id = self.lastRun()
+        rows = self.db.execute("""SELECT test_key, test_id, artifacts FROM tests
+            WHERE run_id = ? AND outcome NOT IN (?, ?) ORDER BY started""", (run_id, PASS, FLAKY))
+        return [(key, test_id, json.loads(artifacts or "[]")) for (key, test_id, artifacts) in rows]
+
+    def history(self, test_key):
+        """ Returns (run id, clients, outcome, duration, reproduced) of a test, over all runs """
+        return self.db.execute("""SELECT run_id, clients, outcome, duration, reproduced FROM tests
+            WHERE test_key = ? ORDER BY run_id""", (test_key,)).fetchall()
+
+    def durations(self, runs = 5):
+        """ Returns {test key: {client: [wall times]}} over the last 'runs' runs """
+        last = self.lastRun() or 0
+        durations = {}
+        for (test_key, client, wall) in self.db.execute("""SELECT test_key, client, wall FROM usage
+                WHERE run_id > ? AND wall IS NOT NULL""", (last - runs,)):
+            durations.setdefault(test_key, {}).setdefault(client, []).append(wall)
+        return durations
+
+    def usageStats(self, run_id = None):
+        """ Returns the `vm.UsageStats` of a run (default the last one) """
+        if run_id is None:
+            run_id = self.lastRun()
+        stats = VMUtils.UsageStats()
+        for row in self.db.execute("SELECT client, wall, user, sys, maxrss FROM usage WHERE run_id = ?", (run_id,)):
+            stats.add(row[0], VMUtils.Usage(*row[1:]))
+        return stats
+
+    def runs(self):
+        """ Returns (run id, started, clients, fork, #tests, #failures, #flaky) of all runs """
+        return self.db.execute("""SELECT r.run_id, r.started, r.clients, r.fork,
+            count(t.test_key), sum(CASE WHEN t.outcome NOT IN (?, ?) THEN 1 ELSE 0 END),
+            sum(CASE WHEN t.outcome = ? THEN 1 ELSE 0 END)
+            FROM runs r LEFT JOIN tests t ON r.run_id = t.run_id
+            GROUP BY r.run_id ORDER BY r.run_id""", (PASS, FLAKY, FLAKY)).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Queries a state test run ledger")
+    parser.add_argument("ledger", type = str, help = "Ledger database")
+    sub = parser.add_subparsers(dest = "command")
+    sub.add_parser("runs", help = "List all runs")
+    failures = sub.add_parser("failures", help = "List the failures of a run")
+    failures.add_argument("run", type = int, nargs = "?", default = None, help = "Run id (default the last run)")
+    history = sub.add_parser("history", help = "Show the outcomes of a test across runs")
+    history.add_argument("test_key", type = str)
+    usage = sub.add_parser("usage", help = "Show the resource usage percentiles per client of a run")
+    usage.add_argument("run", type = int, nargs = "?", default = None, help = "Run id (default the last run)")
+    options = parser.parse_args()
+
+    ledger = RunLedger(options.ledger)
+    if options.command == "failures":
+        for (key, test_id, artifacts) in ledger.failures(options.run):
+            print("%s\t%s" % (test_id, " ".join(artifacts)))
+    elif options.command == "history":
+        for (run_id, clients, outcome, duration, reproduced) in ledger.history(options.test_key):
+            rate = "" if reproduced is None else "\treproduced %.0f%%" % (100 * reproduced)
+            print("%d\t%s\t%s\t%.3f%s" % (run_id, clients, outcome, duration or 0, rate))
+    elif options.command == "usage":
+        print("\n".join(ledger.usageStats(options.run).summary()))
+    else:
+        for (run_id, started, clients, fork, count, fails, flaky) in ledger.runs():
+            print("%d\t%s\t%s\t%s\t%d tests\t%d failures\t%d flaky" % (run_id,
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(started)), clients, fork, count, 
+                fails or 0, flaky or 0))
+    ledger.close()
+
+if __name__ == '__main__':
+    main()
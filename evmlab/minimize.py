@@ -0,0 +1,156 @@
+"""
+Delta-debugging minimizer for failing state tests.
+
+A failing test found by the fuzzer usually carries a lot which has
+nothing to do with the failure: accounts, storage slots, most of the
+code and calldata. The `StateTestMinimizer` removes as much of it as
+possible while the test keeps failing the same way, using `ddmin` over
+
+* the accounts of the prestate,
+* the storage slots of each account,
+* the instructions of the code of each account (a PUSH along with its
+  data, so the rest of the code still decodes the same), and
+* the bytes of the calldata,
+
+until none of them can be reduced any further. Whether a candidate still
+fails is decided by the 'check' function given to the minimizer, which
+gets a list of candidate tests and returns a list of booleans: all the
+candidates of a ddmin round are checked at once, so they can be executed
+in parallel.
+"""
+import copy
+import logging
+logger = logging.getLogger()
+
+from . import compiler
+
+def ddmin(units, check):
+    """ Returns a 1-minimal sublist of 'units' for which the test still fails.
+    'check' gets a list of candidate sublists and returns whether each of them fails """
+    if not units:
+        return units
+    if check([[]])[0]:
+        return []
+    n = 2
+    while len(units) >= 2:
+        size = -(-len(units) // n)
+        subsets = [units[i:i + size] for i in range(0, len(units), size)]
+        complements = [units[:i] + units[i + size:] for i in range(0, len(units), size)]
+        # with two parts, the subsets and the complements are the same
+        candidates = subsets + (complements if len(subsets) > 2 else [])
+        results = check(candidates)
+        failing = [c for (c, failed) in zip(candidates, results) if failed]
+        if failing:
+            smallest = min(failing, key = len)
+            n = 2 if len(smallest) <= size else max(n - 1, 2)
+            units = smallest
+            continue
+        if n >= len(units):
+            break
+        n = min(2 * n, len(units))
+    return units
+
+def instructions(code):
+    """ Splits code (hex, with or without 0x) into instructions, each opcode along with its push data """
+    if code[:2] == "0x":
+        code = code[2:]
+    result = []
+    i = 0
+    while i < len(code):
+        op = int(code[i:i + 2], 16)
+        length = 2
+        if compiler.PUSH1 <= op <= compiler.PUSH32:
+            length = length + 2 * (op - compiler.PUSH1 + 1)
+        result.append(code[i:i + length])
+        i = i + length
+    return result
+
+def byteList(data):
+    if data[:2] == "0x":
+        data = data[2:]
+    return [data[i:i + 2] for i in range(0, len(data), 2)]
+
+
+class StateTestMinimizer(object):
+    """ Minimizes a state test with a single post-state: {name: test} """
+
+    def __init__(self, statetest, check, rounds = 5):
+        self.statetest = copy.deepcopy(statetest)
+        self.name = list(statetest.keys())[0]
+        self.check = check
+        self.rounds = rounds
+        self.executions = 0
+
+    @property
+    def test(self):
+        return self.statetest[self.name]
+
+    def _variant(self, change):
+        """ A copy of the current test, with 'change' applied to its body """
+        statetest = copy.deepcopy(self.statetest)
+        change(statetest[self.name])
+        return statetest
+
+    def _reduce(self, what, units, apply):
+        """ Runs ddmin over the units, where apply(body, units) makes a test of a
+        subset. Returns True if the test got smaller """
+        def check(candidates):
+            self.executions = self.executions + len(candidates)
+            tests = [self._variant(lambda body, c = c: apply(body, c)) for c in candidates]
+            return self.check(tests)
+
+        reduced = ddmin(units, check)
+        if len(reduced) == len(units):
+            return False
+        logger.info("Minimized %s: %d -> %d", what, len(units), len(reduced))
+        self.statetest = self._variant(lambda body: apply(body, reduced))
+        return True
+
+    def reduceAccounts(self):
+        # The sender and the recipient are not special: without them, the test
+        # fails differently (if at all), so ddmin keeps them
+        units = sorted(self.test['pre'])
+
+        def apply(body, subset):
+            body['pre'] = dict((a, acc) for (a, acc) in body['pre'].items() if a in subset)
+        return self._reduce("accounts", units, apply)
+
+    def reduceStorage(self):
+        units = [(a, slot) for a in sorted(self.test['pre']) for slot in sorted(self.test['pre'][a]['storage'])]
+
+        def apply(body, subset):
+            subset = set(subset)
+            for (a, acc) in body['pre'].items():
+                acc['storage'] = dict((slot, v) for (slot, v) in acc['storage'].items() if (a, slot) in subset)
+        return self._reduce("storage slots", units, apply)
+
+    def reduceCode(self, address):
+        units = list(enumerate(instructions(self.test['pre'][address]['code'])))
+
+        def apply(body, subset):
+            body['pre'][address]['code'] = "0x" + "".join(ins for (i, ins) in subset)
+        return self._reduce("code of %s (instructions)" % address, units, apply)
+
+    def reduceCalldata(self):
+        data = self.test['transaction']['data']
+        units = list(enumerate(byteList(data[0])))
+
+        def apply(body, subset):
+            body['transaction']['data'] = ["0x" + "".join(b for (i, b) in subset)]
+        return self._reduce("calldata (bytes)", units, apply)
+
+    def run(self):
+        """ Minimizes the test, returns it """
+        if not self.check([self.statetest])[0]:
+            raise ValueError("The test does not fail to begin with")
+        for i in range(self.rounds):
+            changed = self.reduceAccounts()
+            changed = self.reduceStorage() or changed
+            for address in sorted(self.test['pre']):
+                if self.test['pre'][address].get('code', '0x') not in ('', '0x'):
+                    changed = self.reduceCode(address) or changed
+            changed = self.reduceCalldata() or changed
+            if not changed:
+                break
+        logger.info("Minimized %s with %d executions", self.name, self.executions)
+        return self.statetest
@@ -0,0 +1,258 @@
+"""
+In-process execution of state tests on pyethereum.
+
+Starting a pyethereum container for every test costs far more than the
+test itself: the interpreter starts, and all of pyethereum is imported,
+every time. The `PyethExecutor` instead imports the state test runner of
+the pyethereum image (containers/pyethereum/run_statetest.py) once per
+process, and executes `compute_state_test_unit` directly. The slogging
+trace and the printed stateRoot are captured in memory, in the same
+format as the container output, so `vm.PyVM.canonicalSteps` applies as is.
+
+The state built for a prestate is kept: consecutive tests with the same
+prestate key (the post-states of a test file) run on it, since
+`compute_state_test_unit` reverts the state to a snapshot after each
+transaction.
+
+The trace logging of pyethereum and sys.stdout belong to the whole
+process, so only one test is executed at a time per process, whichever
+executor it's on (e.g. that of a test generation campaign on a generator
+thread, and that of the test runner). The output is captured only from
+the thread executing the test, and it is timed out on any thread (see
+`deadline`), e.g. on the threads of a client queue.
+
+A `PyethJob` stands in for a `Popen` object in the process info of the
+test runners. The test is executed when its output is read, so the other
+clients (which run as processes) execute concurrently with it.
+"""
+import os, io, sys, time, signal, logging, threading, importlib.util, resource, ctypes, contextlib, traceback
+logger = logging.getLogger()
+
+from .vm import Usage
+
+DEFAULT_RUNNER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "containers", "pyethereum", "run_statetest.py")
+
+
+class Timeout(Exception):
+    pass
+
+# held while any executor of this process executes a test
+execution_lock = threading.Lock()
+# (logger, handler) capturing the trace of the test being executed
+capturing = None
+
+
+@contextlib.contextmanager
+def deadline(timeout):
+    """ Raises `Timeout` in the calling thread if the block takes more than 
+    'timeout' seconds. The main thread is interrupted with SIGALRM, other threads
+    get the exception set asynchronously by a timer thread. Either way, it's 
+    raised between two bytecodes, not while blocked in C code """
+    if timeout is None:
+        yield
+        return
+
+    if threading.current_thread() is threading.main_thread():
+        def expired(signum, frame):
+            raise Timeout()
+        previous = signal.signal(signal.SIGALRM, expired)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            yield
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+        return
+
+    ident = ctypes.c_ulong(threading.get_ident())
+    guard = threading.Lock()
+    state = {'armed': True, 'fired': False}
+
+    def expired():
+        with guard:
+            if state['armed']:
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(ident, ctypes.py_object(Timeout))
+                state['fired'] = True
+
+    timer = threading.Timer(timeout, expired)
+    timer.daemon = True
+    timer.start()
+    try:
+        yield
+    finally:
+        timer.cancel()
+        with guard:
+            state['armed'] = False
+            if state['fired']:
+                # the block ended as it expired: drop the exception if it's still pending
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(ident, None)
+
+
+class ThreadStdout(object):
+    """ Stands in for sys.stdout, so what a thread executing a test prints can
+    be captured, while the other threads keep printing to the real stdout """
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.buffers = {}
+
+    def _stream(self):
+        return self.buffers.get(threading.get_ident(), self.stdout)
+
+    def write(self, text):
+        return self._stream().write(text)
+
+    def flush(self):
+        return self._stream().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+@contextlib.contextmanager
+def captured_stdout(buf):
+    """ Like 'redirect_stdout', but only for the calling thread """
+    stdout = sys.stdout
+    if not isinstance(stdout, ThreadStdout):
+        stdout = sys.stdout = ThreadStdout(stdout)
+    stdout.buffers[threading.get_ident()] = buf
+    try:
+        yield
+    finally:
+        del stdout.buffers[threading.get_ident()]
+
+def _after_fork():
+    """ A forked process (e.g. of the test pool) only has the forking thread: 
+    a test executed on another thread when it was forked (e.g. by a test 
+    generation campaign) left the lock held, and its output redirected """
+    global execution_lock, capturing
+    execution_lock = threading.Lock()
+    if capturing is not None:
+        (log_root, handler) = capturing
+        log_root.removeHandler(handler)
+        capturing = None
+    if isinstance(sys.stdout, ThreadStdout):
+        sys.stdout.buffers.clear()
+
+os.register_at_fork(after_in_child = _after_fork)
+
+
+class PyethExecutor(object):
+    """ Executes state tests on pyethereum, in this process, one at a time """
+
+    def __init__(self, runner = DEFAULT_RUNNER):
+        from ethereum import slogging
+        self.runner = runner
+        # the prestate key and state of the last test
+        self.state_key = None
+        self.state = None
+        self.log_root = slogging.getLogger()
+        handlers = list(self.log_root.handlers)
+
+        # importing the runner configures the (json) trace logging
+        spec = importlib.util.spec_from_file_location("run_statetest", runner)
+        self.module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.module)
+
+        # the trace is captured per test, instead of going to stderr
+        for handler in list(self.log_root.handlers):
+            if handler not in handlers:
+                self.log_root.removeHandler(handler)
+        logger.info("Loaded pyethereum state test runner %s", runner)
+
+    def _state(self, prestate, key):
+        if key is None or key != self.state_key:
+            self.state_key = None
+            self.state = self.module.init_state(prestate['env'], prestate['pre'])
+            self.state_key = key
+        return self.state
+
+    def execute(self, prestate, tx, timeout = None, key = None):
+        """ Executes a transaction (with single data, gasLimit and value) on a
+        prestate. Returns the output lines: the json trace, and the stateRoot.
+        The state is reused from the previous test if it had the same 'key' """
+        with execution_lock:
+            return self._execute(prestate, tx, timeout, key)
+
+    def _execute(self, prestate, tx, timeout, key):
+        global capturing
+        buf = io.StringIO()
+        handler = logging.StreamHandler(buf)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        # only the trace of pyethereum on this thread, not whatever else is logged meanwhile
+        thread = threading.get_ident()
+        handler.addFilter(lambda record: record.name.startswith('eth') and record.thread == thread)
+
+        self.log_root.addHandler(handler)
+        capturing = (self.log_root, handler)
+        completed = False
+        try:
+            # the deadline ends first, so a Timeout raised as it ends is still caught here
+            with captured_stdout(buf), deadline(timeout):
+                state = self._state(prestate, key)
+                # the fork is selected by the runner itself, as in the container
+                self.module.compute_state_test_unit(state, tx, self.module.selectConfig(prestate))
+            completed = True
+        except Timeout:
+            logger.info("TIMEOUT ERROR!")
+        except Exception:
+            # a crash of pyethereum: the trace ends here, as that of the container would
+            logger.info("Exception executing pyethereum test", exc_info = True)
+            buf.write(traceback.format_exc())
+        finally:
+            if not completed:
+                # interrupted before reverting to the snapshot
+                self.state_key = None
+                self.state = None
+            self.log_root.removeHandler(handler)
+            capturing = None
+        return buf.getvalue().splitlines()
+
+
+def forkBlocks(fork):
+    """ The 'config' section of a prestate, which selects the fork in run_statetest.py """
+    # same default as evmlab/genesis.py
+    blocks = 0 if fork == 'Byzantium' else 2000
+    config = dict((name, blocks) for name in ('metropolisBlock', 'eip158Block', 
+        'eip150Block', 'eip155Block', 'homesteadBlock'))
+    if fork == 'Homestead':
+        config['homesteadBlock'] = 0
+    return config
+
+
+def singleTx(tx):
+    """ The transaction of a single state test, with the data, gasLimit and
+    value lists replaced by their (only) element, as pyethereum expects """
+    return dict(tx, data = tx['data'][0], gasLimit = tx['gasLimit'][0], value = tx['value'][0])
+
+
+class PyethJob(object):
+    """ A test executed by a `PyethExecutor`. The CPU times are those of this
+    process while executing the test, and the max RSS that of this process """
+
+    def __init__(self, executor, prestate, tx, key = None):
+        self.executor = executor
+        self.prestate = prestate
+        self.tx = tx
+        self.key = key
+        self.finished = False
+        self.usage = None
+        self.started = time.time()
+
+    def stream(self, timeout = 45):
+        if self.finished:
+            return
+        self.finished = True
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        started = time.time()
+        lines = self.executor.execute(self.prestate, self.tx, timeout, self.key)
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        self.usage = Usage(time.time() - started, after.ru_utime - before.ru_utime,
+            after.ru_stime - before.ru_stime, after.ru_maxrss)
+        yield from lines
+
+    def result(self, timeout = 45):
+        return list(self.stream(timeout))
+
+    def abort(self):
+        self.finished = True
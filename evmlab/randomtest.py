@@ -0,0 +1,187 @@
+"""
+In-process generator of random GeneralStateTests.
+
+Tests are built from `compiler.Program` fragments: every fragment pushes
+random arguments for an opcode, executes it, and stores the result (if
+any) in a fresh storage slot, so the outcome of each operation ends up
+in the post state. The `pre` state holds the sender, the contract the
+transaction is sent to, and a few more contracts (and the precompiles)
+for the calls to go to. The transaction gets vectors of data, gas limits
+and values, and the post section of the fork has one entry per
+combination of them.
+
+Test number `i` from a generator with seed `s` is always the same, so any
+test can be reproduced from (s, i) alone:
+
+    StateTestGenerator(seed = 1337).generate(42)
+
+The generator is a drop-in replacement for `testeth --createRandomTest`:
+it returns the test under the name 'randomStatetest'.
+"""
+import random, itertools
+
+from . import compiler
+from . import opcodes
+
+# the usual sender of the ethereum/tests
+SENDER = "0xa94f5374fce5edbc8e2a8697c15331677e6ebf0b"
+SECRET_KEY = "0x45a915e4d060149eb4365960e6a7a45f334393093061116b197e3240065ff2d8"
+TARGET = "0x0f572e5295c57f15886f9b263e2f6d2d6c7b5ec6"
+OTHERS = ["0x%040x" % (0x1000 + i) for i in range(3)]
+PRECOMPILES = ["0x%040x" % i for i in range(1, 9)]
+
+ENV = {
+    "currentCoinbase" : "0x2adc25665018aa1fe0e6bc666dac8fc2697ff9ba",
+    "currentDifficulty" : "0x020000",
+    "currentGasLimit" : "0x7fffffffffffffff",
+    "currentNumber" : "0x01",
+    "currentTimestamp" : "0x03e8",
+    "previousHash" : "0x5e20a0453cecd065ea59c37ac63e079ee08998b6045136a8ce6635c7912ec0b6",
+}
+
+INTERESTING = [0, 1, 2, 31, 32, 33, 255, 256, 2**31, 2**63, 2**64, 2**128, 2**255, 2**256 - 1, 2**256 - 2]
+
+# Control flow and terminators are not part of the random fragments
+EXCLUDED = {'JUMP', 'JUMPI', 'STOP', 'RETURN', 'REVERT', 'SUICIDE'}
+TERMINATORS = [compiler.STOP, compiler.RETURN, compiler.REVERT, compiler.SELFDESTRUCT, None]
+
+# ops which take memory offsets and sizes, or gas, as arguments
+MEMORY_OPS = {'SHA3', 'CALLDATACOPY', 'CODECOPY', 'EXTCODECOPY', 'RETURNDATACOPY', 'MLOAD', 'MSTORE',
+    'MSTORE8', 'LOG0', 'LOG1', 'LOG2', 'LOG3', 'LOG4', 'CREATE', 'CALL', 'CALLCODE', 'DELEGATECALL',
+    'STATICCALL'}
+CALL_OPS = {'CALL', 'CALLCODE', 'DELEGATECALL', 'STATICCALL'}
+
+HEX = ["%02x" % op for op in range(256)]
+ADDRESSES = [int(a, 16) for a in [TARGET, SENDER] + OTHERS + PRECOMPILES]
+
+
+class StateTestGenerator(object):
+
+    def __init__(self, seed = None, fork = 'Byzantium', max_fragments = 32, max_combinations = 8):
+        if seed is None:
+            seed = random.randrange(2**32)
+        self.seed = seed
+        self.fork = fork
+        self.max_fragments = max_fragments
+        self.max_combinations = max_combinations
+        self.ops = sorted(op for (op, info) in opcodes.opcodes.items()
+            if info[0] not in EXCLUDED and not info[0].startswith('PUSH')
+            and (fork == 'Byzantium' or op not in opcodes.opcodesMetropolis))
+
+    def generate(self, index):
+        """ Returns test number 'index', as {'randomStatetest' : test}"""
+        rng = random.Random("%d-%d" % (self.seed, index))
+
+        pre = {
+            SENDER : { "balance" : "0x0de0b6b3a7640000", "code" : "0x", "nonce" : "0x00", "storage" : {} },
+            TARGET : self._account(rng, self.code(rng)),
+        }
+        for address in OTHERS[:rng.randint(0, len(OTHERS))]:
+            pre[address] = self._account(rng, self.code(rng, self.max_fragments // 4))
+
+        transaction = {
+            "data" : ["0x" + self._bytes(rng, rng.choice([0, 1, 4, 32, 36, 68, 100]))
+                for i in range(rng.randint(1, 3))],
+            "gasLimit" : [hex(rng.choice([30000, 100000, 400000, 1000000, 4000000]))
+                for i in range(rng.randint(1, 2))],
+            "gasPrice" : "0x01",
+            "nonce" : "0x00",
+            "secretKey" : SECRET_KEY,
+            "to" : TARGET,
+            "value" : [hex(rng.choice([0, 0, 1, 1000, 10**18])) for i in range(rng.randint(1, 2))],
+        }
+
+        combinations = list(itertools.product(range(len(transaction['data'])),
+            range(len(transaction['gasLimit'])), range(len(transaction['value']))))
+        rng.shuffle(combinations)
+        post = [{ "hash" : "0x00", "logs" : "0x00", "indexes" : { "data" : d, "gas" : g, "value" : v }}
+            for (d, g, v) in sorted(combinations[:self.max_combinations])]
+
+        test = {
+            "_info" : { "comment" : "evmlab random test, seed %d index %d" % (self.seed, index) },
+            "env" : dict(ENV),
+            "pre" : pre,
+            "transaction" : transaction,
+            "post" : { self.fork : post },
+        }
+        return { "randomStatetest" : test }
+
+    def tests(self, start = 0):
+        """ Yields (index, test) from 'start' on """
+        for index in itertools.count(start):
+            yield (index, self.generate(index))
+
+    def _account(self, rng, code):
+        storage = {}
+        for i in range(rng.randint(0, 3)):
+            storage[hex(rng.randint(0, 8))] = hex(self._value(rng))
+        return { "balance" : hex(rng.choice([0, 1, 10**18])), "code" : "0x" + code,
+            "nonce" : "0x00", "storage" : storage }
+
+    def _bytes(self, rng, n):
+        return "".join("%02x" % rng.randint(0, 255) for i in range(n))
+
+    def _value(self, rng, small = False):
+        r = rng.random()
+        if small or r < 0.5:
+            return int(r * 130) % 65
+        if r < 0.75:
+            return rng.choice(INTERESTING)
+        if r < 0.85:
+            return rng.choice(ADDRESSES)
+        return rng.getrandbits(256)
+
+    def code(self, rng, max_fragments = None):
+        """ Random code (hex, without 0x) of up to max_fragments fragments """
+        if max_fragments is None:
+            max_fragments = self.max_fragments
+        p = compiler.Program()
+        slot = 0x100
+        for i in range(rng.randint(1, max(1, max_fragments))):
+            op = rng.choice(self.ops)
+            (name, ins, outs, gas) = opcodes.opcodes[op]
+            args = [self._value(rng, small = name in MEMORY_OPS) for j in range(ins)]
+            if name in CALL_OPS:
+                # gas, address, ...
+                args[0] = rng.choice([0, 2300, 100000, self._value(rng)])
+                args[1] = int(rng.choice(OTHERS + PRECOMPILES + [TARGET]), 16)
+            # the program takes hex strings as they are, which is a lot faster
+            for arg in reversed(args):
+                p.push("%x" % arg)
+            p.op(HEX[op])
+            if outs > 0:
+                # keep the result in the post state
+                p.push("%x" % slot).op(HEX[compiler.SSTORE])
+                slot = slot + 1
+                for j in range(outs - 1):
+                    p.op(HEX[compiler.POP])
+
+        terminator = rng.choice(TERMINATORS)
+        if terminator in (compiler.RETURN, compiler.REVERT):
+            if terminator == compiler.REVERT and self.fork != 'Byzantium':
+                terminator = compiler.RETURN
+            p.push(rng.randint(0, 64)).push(rng.randint(0, 64)).op(terminator)
+        elif terminator == compiler.SELFDESTRUCT:
+            p.push(int(rng.choice(OTHERS + [SENDER]), 16)).op(terminator)
+        elif terminator is not None:
+            p.op(terminator)
+        return p.bytecode()
+
+
+def simpleTest(fork = 'Byzantium', code = "0x600160005500"):
+    """ A test which any working client executes: a transaction to 'code'
+    (by default SSTORE(0, 1), STOP), as {'simpleStatetest' : test} """
+    test = {
+        "_info" : { "comment" : "evmlab simple test" },
+        "env" : dict(ENV),
+        "pre" : {
+            SENDER : { "balance" : "0x0de0b6b3a7640000", "code" : "0x", "nonce" : "0x00", "storage" : {} },
+            TARGET : { "balance" : "0x00", "code" : code, "nonce" : "0x00", "storage" : {} },
+        },
+        "transaction" : {
+            "data" : ["0x"], "gasLimit" : ["0x0186a0"], "gasPrice" : "0x01", "nonce" : "0x00",
+            "secretKey" : SECRET_KEY, "to" : TARGET, "value" : ["0x00"],
+        },
+        "post" : { fork : [{ "hash" : "0x00", "logs" : "0x00", "indexes" : { "data" : 0, "gas" : 0, "value" : 0 }}] },
+    }
+    return { "simpleStatetest" : test }
@@ -0,0 +1,104 @@
+"""
+Persistent, content-addressed cache of state test results.
+
+Results are keyed on the hash of the (single) test content, the digest
+of the client binary or docker image, and the fork. For each key, the
+cache stores the rolling digest of the canonical trace (see
+`vm.TraceDigest`) and the post stateRoot. When re-running a test corpus
+after upgrading one client, only that client needs to be executed again;
+the others are compared using their cached digests.
+"""
+import os, sqlite3, hashlib, json
+from subprocess import check_output
+import logging
+logger = logging.getLogger()
+
+from . import vm as VMUtils
+
+_client_digests = {}
+
+def binaryDigest(path):
+    """ Returns the sha256 of a binary. The result is memoized on (path, mtime, size) """
+    st = os.stat(path)
+    key = (path, st.st_mtime, st.st_size)
+    if key not in _client_digests:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        _client_digests[key] = "sha256:%s" % h.hexdigest()
+    return _client_digests[key]
+
+def imageDigest(image):
+    """ Returns the id of a docker image. The result is memoized for the run """
+    if image not in _client_digests:
+        _client_digests[image] = check_output(["docker", "image", "inspect",
+            "--format", "{{.Id}}", image]).decode().strip()
+    return _client_digests[image]
+
+def clientDigest(name, isDocker):
+    """ Digest of a client, given the (name, isDocker) from 'getBaseCmd'"""
+    if isDocker:
+        return imageDigest(name)
+    return binaryDigest(name)
+
+def contentHash(data):
+    """ Hash of the test content, as written to the test file """
+    if isinstance(data, str):
+        data = data.encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+class ResultCache(object):
+    """ SQLite-backed result cache. Writes are committed in batches; a
+    connection must not be shared between processes"""
+
+    def __init__(self, path, batch = 100):
+        self.path = path
+        self.batch = batch
+        self.uncommitted = 0
+        self.db = sqlite3.connect(path, timeout = 60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS results (
+            test_hash     TEXT NOT NULL,
+            client_digest TEXT NOT NULL,
+            fork          TEXT NOT NULL,
+            client        TEXT NOT NULL,
+            trace_digest  TEXT NOT NULL,
+            state_root    TEXT,
+            checkpoints   TEXT NOT NULL,
+            interval      INTEGER NOT NULL,
+            PRIMARY KEY (test_hash, client_digest, fork))""")
+        self.db.commit()
+
+    def get(self, test_hash, client_digest, fork):
+        """ Returns the cached `vm.TraceDigest` for the key, or None """
+        row = self.db.execute("""SELECT trace_digest, state_root, checkpoints, interval
+            FROM results WHERE test_hash = ? AND client_digest = ? AND fork = ?""",
+            (test_hash, client_digest, fork)).fetchone()
+        if row is None:
+            return None
+        (trace_digest, state_root, checkpoints, interval) = row
+        return VMUtils.TraceDigest.fromDict({
+            'digest' : trace_digest,
+            'stateRoot' : state_root,
+            'checkpoints' : json.loads(checkpoints),
+            'interval' : interval,
+        })
+
+    def put(self, test_hash, client_digest, fork, client, trace_digest):
+        d = trace_digest.toDict()
+        self.db.execute("""INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (test_hash, client_digest, fork, client, d['digest'], d['stateRoot'],
+            json.dumps(d['checkpoints']), d['interval']))
+        self.uncommitted = self.uncommitted + 1
+        if self.uncommitted >= self.batch:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
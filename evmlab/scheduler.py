@@ -0,0 +1,74 @@
+"""
+Cost-aware scheduling of state tests, based on the durations recorded in
+the run ledger (see `ledger.RunLedger.durations`).
+
+The `CostModel` estimates the duration of a test (the slowest client,
+since the clients run concurrently), and derives per-client timeouts
+from the history of the test. A new test gets the default timeout, or
+more if the history of the client calls for it.
+`order` sorts a queue of tests longest-first, which keeps the makespan
+low when the tests are spread over parallel workers, or shortest-first,
+which gets through as many tests as possible in a quick smoke run.
+"""
+import logging
+logger = logging.getLogger()
+
+from . import vm as VMUtils
+
+NONE = 'none'
+LONGEST = 'longest'
+SHORTEST = 'shortest'
+
+class CostModel(object):
+
+    def __init__(self, durations, default_timeout = 30, factor = 3.0, minimum = 5.0):
+        """ 'durations' maps test key -> {client: [wall times]}. Timeouts are
+        'factor' times the longest duration seen, but at least 'minimum' seconds.
+        Without history of the test, the default timeout is used, unless 'factor'
+        times the p99 duration of the client is longer"""
+        self.durations = durations
+        self.default_timeout = default_timeout
+        self.factor = factor
+        self.minimum = minimum
+
+        per_client = {}
+        per_test = []
+        for (test_key, clients) in durations.items():
+            for (client, walls) in clients.items():
+                per_client.setdefault(client, []).extend(walls)
+            per_test.append(max(max(walls) for walls in clients.values()))
+        # the worst case of a client, for tests it has no history of
+        self.client_p99 = dict((client, VMUtils.percentile(sorted(walls), 99))
+            for (client, walls) in per_client.items())
+        # the typical duration of a test, for tests without any history
+        self.test_p50 = VMUtils.percentile(sorted(per_test), 50)
+        logger.info("Cost model: history of %d tests, per client p99 %s", len(durations),
+            ", ".join("%s %.2fs" % (c, t) for (c, t) in sorted(self.client_p99.items())))
+
+    def cost(self, test_key):
+        """ Estimated duration of a test, in seconds """
+        clients = self.durations.get(test_key)
+        if not clients:
+            return self.test_p50 or 0
+        return max(VMUtils.percentile(sorted(walls), 50) for walls in clients.values())
+
+    def timeout(self, client, test_key, default = None):
+        """ Timeout of a client on a test """
+        if default is None:
+            default = self.default_timeout
+        walls = self.durations.get(test_key, {}).get(client)
+        if walls:
+            return max(self.minimum, self.factor * max(walls))
+        # a new test may well be slower than what the client usually gets
+        if client in self.client_p99:
+            return max(default, self.factor * self.client_p99[client])
+        return default
+
+
+def order(items, cost, mode):
+    """ Orders the items by cost (a function of an item), longest or shortest first """
+    if mode == LONGEST:
+        return sorted(items, key = cost, reverse = True)
+    if mode == SHORTEST:
+        return sorted(items, key = cost)
+    return items
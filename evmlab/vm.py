@@ -1,5 +1,5 @@
-import os, signal, json, itertools, traceback, sys
-from subprocess import Popen, PIPE, TimeoutExpired
+import os, signal, json, itertools, traceback, sys, threading, collections, hashlib, time
+from subprocess import Popen, PIPE, DEVNULL, call
 import platform
 import logging
 from . import opcodes
@@ -73,7 +73,53 @@ def canon(str):
         return str
     return "0x" + str
 
+_words = {}
+
+def word(value):
+    """ Parses a stack word or quantity (int, hex- or decimal string) into an int. 
+    Parsed words are cached and shared, since the same values repeat all over a trace"""
+    if isinstance(value, int):
+        return value
+    w = _words.get(value)
+    if w is None:
+        w = int(value, 16) if value[:2] == "0x" else int(value)
+        if len(_words) > 100000:
+            _words.clear()
+        _words[value] = w
+    return w
+
+class Step(collections.namedtuple('Step', ['pc', 'op', 'gas', 'depth', 'stack'])):
+    """ A canonical trace step. The gas is an int and the stack a tuple of ints, 
+    so steps are compared (as tuples) without being formatted to text"""
+    __slots__ = ()
+
+    def text(self):
+        if self.op in opcodes.opcodes:
+            opname = opcodes.opcodes[self.op][0]
+        else:
+            opname = "UNKNOWN"
+        stack = "[%s]" % ", ".join("'0x%x'" % w for w in self.stack)
+        return "pc {:>5} op {:>10}({:>3}) gas {:>8} depth {:>2} stack {}".format(
+            self.pc, opname, self.op, "0x%x" % self.gas, self.depth, stack)
+
+    __str__ = text
+
+class StateRoot(collections.namedtuple('StateRoot', ['stateRoot'])):
+    """ The final step of a canonical trace """
+    __slots__ = ()
+
+    @staticmethod
+    def of(step):
+        return StateRoot(strip_0x(step['stateRoot']).lower())
+
+    def text(self):
+        return "stateRoot {}".format(self.stateRoot)
+
+    __str__ = text
+
 def toText(op):
+    if isinstance(op, (Step, StateRoot)):
+        return op.text()
     if len(op.keys()) == 0:
         return "END"
     if 'pc' in op.keys():
@@ -113,38 +159,275 @@ def getIntrinsicGas(data):
     
     return tx.intrinsic_gas_used
 
-def compare_traces(clients_canon_traces, names):
+class Signature(collections.namedtuple('Signature', ['opcode', 'clients', 'error', 'kind'])):
+    """ Classifies a trace difference by where it is first seen: the opcode whose
+    execution led to it, the clients which disagree with the others, the error 
+    class (a 'step' or the 'stateRoot' differs, a client ends its trace 'early', 
+    or is 'missing' steps), and which parts of the step differ (e.g. 'gas', 
+    'stack', 'gas+stack' or 'pc')"""
+    __slots__ = ()
 
-    """ Compare 'canonical' traces from the clients"""
+    @staticmethod
+    def of(steps, names, previous = None):
+        """ The signature of the first differing 'steps' (one per client, None for
+        a trace which has ended), 'previous' being the last identical step """
+        # the clients outside of the largest group of identical steps, or all of them
+        groups = collections.Counter(steps)
+        (majority, count) = groups.most_common(1)[0]
+        if count > 1 and list(groups.values()).count(count) == 1:
+            clients = [n for (n, s) in zip(names, steps) if s != majority]
+        else:
+            clients = list(names)
+
+        present = [s for s in steps if s is not None]
+        if len(present) < len(steps):
+            error = 'missing'
+        elif all(isinstance(s, StateRoot) for s in present):
+            error = 'stateRoot'
+        elif any(isinstance(s, StateRoot) for s in present):
+            error = 'early'
+        else:
+            error = 'step'
+
+        if len(clients) == len(names) and error in ('missing', 'early'):
+            # without a majority, blame the clients whose traces ended
+            clients = [n for (n, s) in zip(names, steps) if s is None or isinstance(s, StateRoot)]
+
+        kind = error
+        if error == 'step':
+            differing = [f for f in ('depth', 'pc', 'op', 'gas', 'stack') 
+                if len(set(getattr(s, f) for s in present)) > 1]
+            # a different pc, op or depth also makes the gas and stack differ
+            for f in ('depth', 'pc', 'op'):
+                if f in differing:
+                    differing = [f]
+                    break
+            kind = "+".join(differing)
+
+        if isinstance(previous, Step):
+            op = previous.op
+        else:
+            op = next((s.op for s in present if isinstance(s, Step)), None)
+        opname = opcodes.opcodes[op][0] if op in opcodes.opcodes else "UNKNOWN"
+        return Signature(opname, "+".join(sorted(clients)), error, kind)
 
-    full_output = []
-    log = lambda x: full_output.append(x)
+    def text(self):
+        return "|".join(self)
 
+    __str__ = text
 
-    canon_traces = list(itertools.zip_longest(*clients_canon_traces))
+def compare_traces(clients_canon_traces, names, skip = 0, divergence = None, context = None):
 
-    num_clients = len(names)
-    equivalent = True
-    for step in canon_traces:
-        wrong_clients = []
-        step_equiv = True
-        for i in range(1, num_clients):
-            if step[i] != step[0]:
-                step_equiv = False
-                wrong_clients.append(i)
-
-        if step_equiv == True:
-            log('[*] {:>8} {}'.format("", step[0]))
+    """ Compare 'canonical' traces from the clients"""
+
+    return compare_streams(clients_canon_traces, names, skip = skip, divergence = divergence, context = context)
+
+def _wrong_clients(step):
+    return [i for i in range(1, len(step)) if step[i] != step[0]]
+
+def _format_row(step, wrong_clients, names):
+    """ The output lines of one step of the combined trace """
+    text = lambda s: s if s is None or isinstance(s, str) else toText(s)
+    if not wrong_clients:
+        return ['[*] {:>8} {}'.format("", text(step[0]))]
+    lines = []
+    for i in range(0, len(names)):
+        if i in wrong_clients or len(wrong_clients) == len(names)-1:
+            lines.append('[!!] {:>7} {}'.format(names[i], text(step[i])))
         else:
+            lines.append('[*] {:>8} {}'.format(names[i], text(step[i])))
+    return lines
+
+def combined_trace(clients_canon_steps, names, skip = 0):
+    """ Yields the lines of the combined trace of the clients, as they are 
+    compared, leaving out the first 'skip' steps (unless they differ) """
+    if skip:
+        yield '[..] {:>7} {}'.format("", "%d identical steps left out" % skip)
+    for (index, step) in enumerate(itertools.zip_longest(*clients_canon_steps)):
+        wrong_clients = _wrong_clients(step)
+        if index >= skip or wrong_clients:
+            yield from _format_row(step, wrong_clients, names)
+
+def compare_streams(clients_canon_steps, names, tail = None, abort = None, skip = 0, divergence = None, context = None):
+
+    """ Compare 'canonical' traces from the clients, reading the steps from 
+    all of them in lock-step. If a tail is given, only that many steps are 
+    collected after the first difference, after which 'abort' is called 
+    (e.g. to kill the processes still producing the traces) and the 
+    comparison stops. The first 'skip' steps are left out of the output
+    (e.g. when they are already known to be identical).
+
+    With a 'context', only that many steps before the first difference are
+    kept for the output, and (without a tail) the comparison stops that many
+    steps after it, so the memory used does not grow with the traces. The
+    full combined trace can be written with `combined_trace`.
+
+    The steps are only formatted to text if the traces differ, otherwise
+    the returned output is empty. At the first difference, 'divergence' is 
+    called with its `Signature`"""
+
+    if context is not None and tail is None:
+        tail = context
+    equivalent = True
+    extra_steps = 0
+    aborted = False
+    # (steps, wrong clients)
+    rows = collections.deque(maxlen = context) if context else []
+    left_out = skip
+    previous = None
+    for (index, step) in enumerate(itertools.zip_longest(*clients_canon_steps)):
+        wrong_clients = _wrong_clients(step)
+
+        if wrong_clients:
+            if equivalent and divergence is not None:
+                divergence(Signature.of(step, names, previous))
+            if equivalent:
+                # from here on, all the rows are kept
+                rows = list(rows)
             equivalent = False
-            logger.info("")
-            for i in range(0, num_clients):
-                if i in wrong_clients or len(wrong_clients) == num_clients-1:
-                    log('[!!] {:>7} {}'.format(names[i], step[i]))
-                else:
-                    log('[*] {:>8} {}'.format(names[i], step[i]))
+        elif equivalent:
+            previous = step[0]
+        if index >= skip or wrong_clients:
+            if equivalent and context and len(rows) == context:
+                left_out = left_out + 1
+            rows.append((step, wrong_clients))
+
+        if not equivalent and tail is not None:
+            if extra_steps == tail:
+                aborted = True
+                if abort is not None:
+                    abort()
+                for steps in clients_canon_steps:
+                    if hasattr(steps, 'close'):
+                        steps.close()
+                break
+            extra_steps = extra_steps + 1
+
+    if equivalent:
+        return (True, [])
 
-    return (equivalent, full_output)
+    full_output = []
+
+    if left_out:
+        full_output.append('[..] {:>7} {}'.format("", "%d identical steps left out" % left_out))
+
+    for (step, wrong_clients) in rows:
+        full_output.extend(_format_row(step, wrong_clients, names))
+
+    if aborted:
+        full_output.append('[..] {:>7} {}'.format("", "stopped after %d steps past the first difference" % tail))
+
+    return (False, full_output)
+
+
+class TraceDigest(object):
+    """ Rolling digest of a canonical trace. The steps are folded into a hash 
+    one at a time, and the intermediate hash is kept as a checkpoint every 
+    'interval' steps, so that two differing traces can be narrowed down to 
+    the window where they first diverge"""
+
+    def __init__(self, interval = 1000):
+        self.interval = interval
+        self.hash = hashlib.sha1()
+        self.count = 0
+        self.checkpoints = []
+        self.stateRoot = None
+        # set when restored from a stored digest
+        self.final = None
+
+    def update(self, step):
+        self.hash.update(repr(step).encode())
+        self.count = self.count + 1
+        if self.count % self.interval == 0:
+            self.checkpoints.append(self.hash.hexdigest())
+        if isinstance(step, StateRoot):
+            self.stateRoot = step.stateRoot
+
+    def fold(self, steps):
+        for step in steps:
+            self.update(step)
+        return self
+
+    def digest(self):
+        if self.final is not None:
+            return self.final
+        return "%d:%s" % (self.count, self.hash.hexdigest())
+
+    def toDict(self):
+        return {
+            'digest' : self.digest(), 
+            'stateRoot' : self.stateRoot, 
+            'checkpoints' : self.checkpoints, 
+            'interval' : self.interval,
+        }
+
+    @staticmethod
+    def fromDict(d):
+        """ Restores a (finished) digest from 'toDict' """
+        digest = TraceDigest(d['interval'])
+        digest.final = d['digest']
+        digest.count = int(d['digest'].split(":")[0])
+        digest.stateRoot = d['stateRoot']
+        digest.checkpoints = d['checkpoints']
+        return digest
+
+def compare_digests(digests):
+    """ Compare the trace digests of the clients. Returns (equivalent, start), 
+    where start is the number of steps which are known to be identical in all 
+    traces (the last common checkpoint)"""
+
+    if len(set(d.digest() for d in digests)) == 1:
+        return (True, None)
+
+    common = 0
+    if len(set(d.interval for d in digests)) != 1:
+        # checkpoints taken at different intervals can't be compared
+        return (False, 0)
+    for checkpoints in zip(*[d.checkpoints for d in digests]):
+        if len(set(checkpoints)) != 1:
+            break
+        common = common + 1
+
+    return (False, common * digests[0].interval)
+
+def finalState(output):
+    """ Reads only the final stateRoot and gasUsed from the output of a client, 
+    without parsing or canonicalizing any of the trace steps """
+    final = {}
+    for line in output:
+        if line.find('"stateRoot"') == -1 and line.find('"gasUsed"') == -1:
+            continue
+        json_index = line.find("{")
+        if json_index < 0:
+            continue
+        try:
+            obj = json.loads(line[json_index:])
+        except Exception:
+            continue
+        if 'stateRoot' in obj:
+            final['stateRoot'] = strip_0x(obj['stateRoot']).lower()
+        if 'gasUsed' in obj:
+            gas = obj['gasUsed']
+            if isinstance(gas, str):
+                gas = int(gas, 16) if gas[:2] == "0x" else int(gas)
+            final['gasUsed'] = gas
+    return final
+
+def compare_final_states(final_states, names):
+    """ Compare the final stateRoot and gasUsed of the clients. The gasUsed is 
+    only compared if all clients report it"""
+
+    roots = [final.get('stateRoot') for final in final_states]
+    equivalent = None not in roots and len(set(roots)) == 1
+
+    gas = [final.get('gasUsed') for final in final_states]
+    if None not in gas and len(set(gas)) != 1:
+        equivalent = False
+
+    marker = '[*]' if equivalent else '[!!]'
+    output = ['{} {:>7} stateRoot {} gasUsed {}'.format(marker, names[i], roots[i], gas[i]) 
+        for i in range(0, len(final_states))]
+    return (equivalent, output)
 
 
 def startProc(cmd):
@@ -153,23 +436,124 @@ def startProc(cmd):
 
     # need to pass a string to Popen and shell=True to get stdout from docker container
     print(" ".join(cmd))
-    return Popen(" ".join(cmd), stdout=PIPE,shell=True, stderr=PIPE, preexec_fn=os.setsid)
+    process = Popen(" ".join(cmd), stdout=PIPE,shell=True, stderr=PIPE, preexec_fn=os.setsid)
+    process.started = time.time()
+    return process
+
+
+class Usage(collections.namedtuple('Usage', ['wall', 'user', 'sys', 'maxrss'])):
+    """ Resources used by a client process: wall time, user and system CPU seconds, 
+    and max RSS in KiB. The CPU and memory figures are those of the process started
+    on the host (i.e. the docker CLI for docker clients), and are None when unknown"""
+
+    def plus(self, other):
+        if other is None:
+            return self
+        def add(a, b):
+            return None if a is None or b is None else a + b
+        maxrss = None if self.maxrss is None or other.maxrss is None else max(self.maxrss, other.maxrss)
+        return Usage(self.wall + other.wall, add(self.user, other.user), add(self.sys, other.sys), maxrss)
+
+def waitProc(process):
+    """ Waits for a process started by 'startProc', reaping it with wait4 to 
+    get its resource usage, which is stored as 'process.usage' """
+    if process.returncode is not None:
+        return process.returncode
+    try:
+        (pid, status, rusage) = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        # already reaped elsewhere
+        return process.wait()
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    wall = time.time() - getattr(process, 'started', time.time())
+    process.usage = Usage(wall, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss)
+    return process.returncode
+
+def percentile(values, p):
+    """ Nearest-rank percentile of a sorted list """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values))) - 1))]
+
+class UsageStats(object):
+    """ Collects the resource usage per client, and summarizes it as percentiles """
+
+    def __init__(self):
+        self.usages = collections.defaultdict(list)
+
+    def add(self, client, usage):
+        if usage is not None:
+            self.usages[client].append(usage)
+
+    def update(self, usages):
+        """ Adds a dict of client name -> Usage """
+        for (client, usage) in (usages or {}).items():
+            self.add(client, usage)
+
+    def summary(self, percentiles = (50, 90, 99, 100)):
+        """ Returns the lines of a per-client table of usage percentiles """
+        lines = ["Resource usage per client (%s)" % " / ".join("p%d" % p for p in percentiles)]
+        for client in sorted(self.usages):
+            usages = self.usages[client]
+            lines.append("  %s: %d tests" % (client, len(usages)))
+            for (field, unit, fmt) in [('wall', 's', '%.3f'), ('user', 's', '%.3f'), 
+                                       ('sys', 's', '%.3f'), ('maxrss', 'KiB', '%d')]:
+                values = sorted(getattr(u, field) for u in usages if getattr(u, field) is not None)
+                if not values:
+                    continue
+                lines.append("    %-6s %s %s" % (field, 
+                    " / ".join(fmt % percentile(values, p) for p in percentiles), unit))
+        return lines
 
 
-def finishProc(process, extraTime=False, output="stdout", timeout = 30):
+def streamProc(process, extraTime=False, output="stdout", timeout = 30, kill_cmd = None):
+    """ Yields the lines of the process output (stdout or stderr) as they arrive, 
+    so the full output never needs to be held in memory. The other stream is 
+    drained and discarded in the background. If the process does not finish 
+    within the timeout, the process group is killed, which ends the stream.
+    A 'kill_cmd' is run first, for what the process group does not contain
+    (e.g. the evm in a docker container)"""
 
     if extraTime:
         timeout = 45
-    try:
-        (stdoutdata, stderrdata) = process.communicate(timeout=timeout)
-    except TimeoutExpired:
+
+    (traced, other) = (process.stdout, process.stderr)
+    if output != 'stdout':
+        (traced, other) = (other, traced)
+
+    def drain():
+        for line in iter(other.readline, b''):
+            pass
+
+    def kill():
         logger.info("TIMEOUT ERROR!")
-        os.killpg(process.pid, signal.SIGINT) # send signal to the process group
-        (stdoutdata, stderrdata) = process.communicate()
+        if kill_cmd is not None:
+            call(kill_cmd, stdout = DEVNULL, stderr = DEVNULL)
+        try:
+            os.killpg(process.pid, signal.SIGINT) # send signal to the process group
+        except ProcessLookupError:
+            pass
+
+    drainer = threading.Thread(target = drain)
+    drainer.daemon = True
+    drainer.start()
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        for line in iter(traced.readline, b''):
+            yield line.decode().rstrip("\r\n")
+    finally:
+        traced.close()
+        drainer.join()
+        other.close()
+        waitProc(process)
+        timer.cancel()
 
-    if output == 'stdout':
-        return stdoutdata.decode().strip().split("\n")
-    return stderrdata.decode().strip().split("\n")
+def finishProc(process, extraTime=False, output="stdout", timeout = 30):
+    return list(streamProc(process, extraTime, output, timeout))
 
 class VM(object):
 
@@ -191,33 +575,38 @@ class CppVM(VM):
 
     @staticmethod
     def canonicalized(output):
+        return list(CppVM.canonicalSteps(output))
+
+    @staticmethod
+    def canonicalSteps(output):
+        """ Generator of canonical steps, consuming the output lines lazily """
         from . import opcodes
         valid_opcodes = opcodes.reverse_opcodes.keys()
 
-        steps = []
-        for x in output:
-            try:
-                if x[0:2] == "[{":
-                        steps = json.loads(x)
+        def json_steps():
+            for x in output:
+                try:
+                    if x[0:2] == "[{":
+                        yield from json.loads(x)
 
-                if x[0:2] == "{\"":
-                    step = json.loads(x)
-                    if 'stateRoot' in step.keys():
-                        steps.append(step)
+                    if x[0:2] == "{\"":
+                        step = json.loads(x)
+                        if 'stateRoot' in step.keys():
+                            yield step
 
-            except Exception as e:
-                logger.info('Exception parsing cpp json:')
-                logger.info(e)
-                logger.info('problematic line:')
-                logger.info(x)
+                except Exception as e:
+                    logger.info('Exception parsing cpp json:')
+                    logger.info(e)
+                    logger.info('problematic line:')
+                    logger.info(x)
 
-        canon_steps = []
+        num_steps = 0
 
         try:
-            for step in steps:
+            for step in json_steps():
                 if 'stateRoot' in step.keys():
-                    if len(canon_steps): # dont log state root if no previous EVM steps
-                        canon_steps.append(step) # should happen last
+                    if num_steps: # dont log state root if no previous EVM steps
+                        yield StateRoot.of(step) # should happen last
                     continue
                 if step['op'] in ['INVALID', 'STOP'] :
                     # skip STOPs
@@ -227,28 +616,29 @@ class CppVM(VM):
                     logger.info(step)
                     continue
 
-                trace_step = {
-                    'pc'  : step['pc'],
-                    'gas': '0x{0:01x}'.format(int(step['gas'])) ,
-                    'op': opcodes.reverse_opcodes[step['op']],
-                    'depth' : step['depth'],
-                    'stack' : toHexQuantities(step['stack']),
-                }
-                canon_steps.append(trace_step)
+                trace_step = Step(
+                    pc = step['pc'],
+                    gas = word(step['gas']),
+                    op = opcodes.reverse_opcodes[step['op']],
+                    depth = step['depth'],
+                    stack = tuple(word(el) for el in step['stack']),
+                )
+                num_steps = num_steps + 1
+                yield trace_step
         except Exception as e:
             logger.info('Exception parsing cpp step:')
             logger.info(e)
 
-        return canon_steps
-
 class PyVM(VM):
 
     @staticmethod
     def canonicalized(output):
-        from . import opcodes
+        return list(PyVM.canonicalSteps(output))
 
-        def formatStackItem(el):
-            return '0x{0:01x}'.format(int(el.replace("b", "").replace("'", "")))
+    @staticmethod
+    def canonicalSteps(output):
+        """ Generator of canonical steps, consuming the output lines lazily """
+        from . import opcodes
 
         def json_steps():
             for line in output:
@@ -267,13 +657,13 @@ class PyVM(VM):
                         logger.info(line)
                         yield({})
 
-        canon_steps = []
+        num_steps = 0
         for step in json_steps():
             #print (step)
             if 'stateRoot' in step.keys():
                 # dont log stateRoot when tx doesnt execute, to match cpp and parity
-                if len(canon_steps):
-                    canon_steps.append(step)
+                if num_steps:
+                    yield StateRoot.of(step)
                 continue
             if 'event' not in step.keys():               
                 continue
@@ -286,18 +676,15 @@ class PyVM(VM):
                     # can't distinguish them from actual STOPs (that pyeth logs)
                     continue
 
-                trace_step = {
-                    'opName' : step['op'],
-                    'op'     : step['inst'],
-                    'depth'  : step['depth'],
-                    'pc'     : bstrToInt(step['pc']),
-                    'gas'    : bstrToHex(step['gas']),
-                }
-
-                trace_step['stack'] = [formatStackItem(el) for el in step['stack']]
-                canon_steps.append(trace_step)
-
-        return canon_steps
+                trace_step = Step(
+                    op     = step['inst'],
+                    depth  = step['depth'],
+                    pc     = bstrToInt(step['pc']),
+                    gas    = bstrToInt(step['gas']),
+                    stack  = tuple(bstrToInt(el) for el in step['stack']),
+                )
+                num_steps = num_steps + 1
+                yield trace_step
 
 
 class GethVM(VM):
@@ -370,36 +757,38 @@ class GethVM(VM):
 
     @staticmethod
     def canonicalized(output):
+        return list(GethVM.canonicalSteps(output))
+
+    @staticmethod
+    def canonicalSteps(output):
+        """ Generator of canonical steps, consuming the output lines lazily """
         from . import opcodes
-        parsed_steps = []
-        for line in output:
-            if len(line) > 0 and line[0] == "{":
-                try:
-                    parsed_steps.append(json.loads(line))
-                except Exception as e:
-                    logger.warn('Exception [1] parsing geth output:')
-                    traceback.print_exc(file=sys.stdout)
-                    logger.warn(e)
-
-        canon_steps = []
-        if len(parsed_steps) == 0:
-            return canon_steps
-            
-        try:
-            if 'output' in parsed_steps[-1]:
-                # last one is {"output":"","gasUsed":"0x34a48","time":4787059}
-                # Remove    
-                parsed_steps = parsed_steps[:-1]
 
-            for step in parsed_steps:
+        def parsed_steps():
+            for line in output:
+                if len(line) > 0 and line[0] == "{":
+                    try:
+                        yield json.loads(line)
+                    except Exception as e:
+                        logger.warn('Exception [1] parsing geth output:')
+                        traceback.print_exc(file=sys.stdout)
+                        logger.warn(e)
+
+        num_steps = 0
+        try:
+            for step in parsed_steps():
                 if 'stateRoot' in step.keys() :
                     # don't log stateRoot when tx doesnt execute, to match cpp and parity
                     # should be last step
-                    if len(canon_steps):
-                        canon_steps.append(step)
+                    if num_steps:
+                        yield StateRoot.of(step)
                     
                     continue
 
+                if 'output' in step.keys() and not 'op' in step.keys():
+                    # final one is {"output":"","gasUsed":"0x34a48","time":4787059}
+                    continue
+
                 if not 'op' in step.keys():
                     logger.warn("Missing 'op': %s" % str(step))
                     continue
@@ -410,22 +799,21 @@ class GethVM(VM):
                 if step['opName'] == "" or step['op'] not in opcodes.opcodes:
                     # invalid opcode
                     continue
-                trace_step = {
-                    'pc'  : step['pc'],
-                    'gas': step['gas'],
-                    'op': step['op'],
+                trace_step = Step(
+                    pc = step['pc'],
+                    gas = word(step['gas']),
+                    op = step['op'],
                     # we want a 0-based depth
-                    'depth' : step['depth'] -1,
-                    'stack' : step['stack'],
-                }
-                canon_steps.append(trace_step)
+                    depth = step['depth'] -1,
+                    stack = tuple(word(el) for el in step['stack']),
+                )
+                num_steps = num_steps + 1
+                yield trace_step
         except Exception as e:
             logger.warn('Exception [2] parsing geth output:')
             traceback.print_exc(file=sys.stdout)
             logger.warn(e)
 
-        return canon_steps
-
 
 
 class ParityVM(VM):
@@ -498,19 +886,25 @@ class ParityVM(VM):
 
     @staticmethod
     def canonicalized(output):
+        return list(ParityVM.canonicalSteps(output))
+
+    @staticmethod
+    def canonicalSteps(output):
+        """ Generator of canonical steps, consuming the output lines lazily """
         from . import opcodes
-        parsed_steps = []
-        for line in output:
-            if len(line) > 0 and line[0] == "{":
-                try:
-                    parsed_steps.append(json.loads(line))
-                except Exception as e:
-                    logger.warn('Exception [1] parsing parity output:')
-                    logger.warn(e)
 
-        canon_steps = []
+        def parsed_steps():
+            for line in output:
+                if len(line) > 0 and line[0] == "{":
+                    try:
+                        yield json.loads(line)
+                    except Exception as e:
+                        logger.warn('Exception [1] parsing parity output:')
+                        logger.warn(e)
+
+        num_steps = 0
         try:
-            for p_step in parsed_steps:
+            for p_step in parsed_steps():
                 if 'test' in p_step.keys():
                     # first step of trace has test name
                     continue
@@ -518,8 +912,8 @@ class ParityVM(VM):
                 if 'stateRoot' in p_step.keys():
                     # dont log the stateRoot for basic tx's (that have no EVM steps)
                     # should be last step
-                    if len(canon_steps):
-                        canon_steps.append(p_step)
+                    if num_steps:
+                        yield StateRoot.of(p_step)
                     continue
 
                 # Ignored for now
@@ -536,20 +930,19 @@ class ParityVM(VM):
                 if p_step['opName'] == "" or p_step['op'] not in opcodes.opcodes:
                     # invalid opcode
                     continue
-                trace_step = {
-                    'pc'  : p_step['pc'],
-                    'gas': p_step['gas'],
-                    'op': p_step['op'],
+                trace_step = Step(
+                    pc = p_step['pc'],
+                    gas = word(p_step['gas']),
+                    op = p_step['op'],
                     # parity depth starts at 1, but we want a 0-based depth
-                    'depth' : p_step['depth'] -1,
-                    'stack' : p_step['stack'],
-                }
-                canon_steps.append(trace_step)
+                    depth = p_step['depth'] -1,
+                    stack = tuple(word(el) for el in p_step['stack']),
+                )
+                num_steps = num_steps + 1
+                yield trace_step
         except Exception as e:
             logger.warn('Exception [2] parsing parity output:')
             logger.warn(e)
 
-        return canon_steps
-
 
 
@@ -0,0 +1,512 @@
+"""
+Long-lived per-client workers, so that running a state test does not
+pay for a fresh `docker run --rm` (or process spawn) for every single
+(data, gas, value) case.
+
+Two kinds of workers are available:
+
+* `DockerWorker` keeps one warm container per client running, with a
+  spool directory mounted into it. Tests are written into the spool
+  directory, and each one is executed via `docker exec` in the already
+  running container, which avoids container creation and teardown.
+
+* `StdinWorker` keeps one client process running, and sends it the paths
+  of test files over stdin. The output of the process is split back into
+  per-test traces using the `stateRoot` marker which clients emit at the
+  end of each test (e.g. geth `evm statetest` without a file argument).
+  Clients with a request protocol (e.g. the pyethereum runner with
+  `--server`, which reads json requests and ends each trace with a
+  delimiter record) are sent a request line per test instead. The
+  prestate of a request is only sent when it differs from the last one.
+
+Along the same lines, `BatchRun` splits the output of a client which was
+given a test file with many post-states into one `BatchJob` per post-state.
+
+`ClientQueues` executes tests with a queue (and number of threads) per
+client, so each client works through the tests at its own pace, and joins
+the results per test.
+
+`ProducerPool` runs test generators in the background, so that generating
+tests overlaps with executing them.
+"""
+import os, json, signal, platform, shutil, tempfile, threading, queue, time, collections, itertools
+from subprocess import Popen, PIPE, DEVNULL, check_output, call
+import logging
+logger = logging.getLogger()
+
+from .vm import Usage
+
+
+def hostPath(path):
+    """ Returns the path as seen by the docker daemon """
+    if platform.system() == 'Darwin':
+        return os.path.join('/private', path.strip('/'))
+    return path
+
+
+container_numbers = itertools.count()
+
+def containerName(client):
+    """ Returns a unique name for the container (or the process in a warm container)
+    executing a test, so that it can be killed: killing the docker client process 
+    does not stop what it runs in the container """
+    return "evmlab-%s-%d-%d" % (client, os.getpid(), next(container_numbers))
+
+
+class Spool(object):
+    """ A directory where test files are placed for the workers to pick up.
+    Each test gets its own file, so tests in flight never overwrite each other"""
+
+    def __init__(self, path = None):
+        if path is None:
+            path = tempfile.mkdtemp(prefix = "evmlab-spool-")
+        else:
+            os.makedirs(path, exist_ok = True)
+        self.path = os.path.abspath(path)
+
+    def file(self, name):
+        return os.path.join(self.path, "%s.json" % name)
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors = True)
+
+
+class DockerWorker(object):
+    """ Keeps a warm container for a client image. The container just idles,
+    and tests are executed inside it using `docker exec`"""
+
+    def __init__(self, image, mounts = None):
+        self.image = image
+        self.mounts = mounts or {}
+        self.container = None
+        self.entrypoint = []
+
+    def start(self):
+        if self.container is not None:
+            return self
+        entrypoint = check_output(["docker", "image", "inspect", "--format",
+            "{{json .Config.Entrypoint}}", self.image]).decode().strip()
+        self.entrypoint = json.loads(entrypoint) or []
+
+        cmd = ["docker", "run", "-d", "--rm", "--entrypoint", "tail"]
+        for (host, container) in self.mounts.items():
+            cmd.extend(["-v", "%s:%s" % (hostPath(host), container)])
+        cmd.extend([self.image, "-f", "/dev/null"])
+        self.container = check_output(cmd).decode().strip()
+        logger.info("Started worker container %s for %s", self.container[:12], self.image)
+        return self
+
+    def command(self, args, name = None):
+        """ Returns the command which executes the image entrypoint, with the given
+        arguments, inside the warm container. Given a 'name', the process records
+        its pid, so that it can be killed (see `killCommand`) """
+        if name is None:
+            return ["docker", "exec", "-t", self.container] + self.entrypoint + args
+        script = "'echo $$ > /tmp/%s.pid && exec \"$0\" \"$@\"'" % name
+        return ["docker", "exec", "-t", self.container, "sh", "-c", script] + self.entrypoint + args
+
+    def killCommand(self, name):
+        """ Returns the command which kills the process started as 'name' """
+        return ["docker", "exec", self.container, "sh", "-c", "kill -9 $(cat /tmp/%s.pid)" % name]
+
+    def stop(self):
+        if self.container is None:
+            return
+        call(["docker", "rm", "-f", self.container], stdout = DEVNULL, stderr = DEVNULL)
+        self.container = None
+
+
+class StdinWorker(object):
+    """ Keeps one client process running, which reads test file paths on stdin.
+    The output is routed to the submitted jobs in order, switching to the next 
+    job whenever the end-of-test marker is seen. Lines are written to the process
+    by a thread of their own, since a write can block until the process has read
+    the lines before it, and it needs its output routed to do so"""
+
+    def __init__(self, cmd, output = "stderr", marker = '"stateRoot"'):
+        self.cmd = cmd
+        self.output = output
+        self.marker = marker
+        self.proc = None
+        self.lock = threading.RLock()
+        # jobs submitted, whose output is not yet complete
+        self.jobs = collections.deque()
+        # lines to write to the process, and the key of the last prestate sent to it
+        self.writes = None
+        self.prestate_key = None
+
+    def start(self):
+        with self.lock:
+            if self.proc is not None and self.proc.poll() is None:
+                return self
+
+            proc = Popen(self.cmd, stdin = PIPE, stdout = PIPE, stderr = PIPE, preexec_fn = os.setsid)
+            self.proc = proc
+            self.writes = queue.Queue()
+            self.prestate_key = None
+
+            (traced, other) = (proc.stderr, proc.stdout)
+            if self.output == "stdout":
+                (traced, other) = (other, traced)
+
+            for (target, stream) in [(self._route, traced), (self._drain, other), (self._write, self.writes)]:
+                t = threading.Thread(target = target, args = (proc, stream))
+                t.daemon = True
+                t.start()
+
+            logger.info("Started worker process %d: %s", proc.pid, " ".join(self.cmd))
+            return self
+
+    def _drain(self, proc, stream):
+        for line in iter(stream.readline, b''):
+            pass
+
+    def _write(self, proc, writes):
+        for line in iter(writes.get, None):
+            try:
+                proc.stdin.write(line)
+                proc.stdin.flush()
+            except (BrokenPipeError, ValueError):
+                # the process is gone, its pending jobs are resubmitted to the next one
+                return
+
+    def _route(self, proc, stream):
+        for raw in iter(stream.readline, b''):
+            line = raw.decode().rstrip("\r\n")
+            with self.lock:
+                if proc is not self.proc or not self.jobs:
+                    # output of a killed process, or not belonging to any test
+                    continue
+                job = self.jobs[0]
+                job.put(line)
+                if line.find(self.marker) != -1:
+                    job.markers = job.markers - 1
+                    if job.markers == 0:
+                        self.jobs.popleft()
+                        job.put(None)
+
+        with self.lock:
+            if proc is not self.proc:
+                return
+            logger.info("Worker process exited unexpectedly")
+            self.proc = None
+            self.writes.put(None)
+            if self.jobs:
+                self.jobs.popleft().put(None)
+            self._resubmit()
+
+    def _send(self, job):
+        """ Queues the line of a job for the writer. Called with the lock held, 
+        in the order the jobs are routed """
+        line = job.testfile
+        if job.request is not None:
+            request = job.request
+            key = request.get('prestate_key')
+            if key is None or key != self.prestate_key:
+                request = dict(request, prestate = job.prestate)
+            self.prestate_key = key
+            line = json.dumps(request)
+        self.writes.put(("%s\n" % line).encode())
+
+    def _resubmit(self):
+        """ Starts a new process, which is fed the tests that were still pending """
+        if self.jobs:
+            self.start()
+            for job in self.jobs:
+                self._send(job)
+
+    def submit(self, job):
+        with self.lock:
+            self.start()
+            self.jobs.append(job)
+            self._send(job)
+        return self
+
+    def abort(self, job):
+        """ Drops a test. If the worker is currently executing it, the worker is
+        restarted, since the rest of its output would otherwise end up in the 
+        next test """
+        with self.lock:
+            if job not in self.jobs:
+                return
+            if job is not self.jobs[0]:
+                # Not started yet, its output is still routed to it and discarded
+                return
+            self.jobs.popleft()
+            self.stop()
+            self._resubmit()
+
+    def stop(self):
+        with self.lock:
+            if self.proc is None:
+                return
+            proc = self.proc
+            self.proc = None
+            self.writes.put(None)
+        try:
+            os.killpg(proc.pid, signal.SIGINT)
+        except ProcessLookupError:
+            pass
+        proc.wait()
+
+
+class StdinJob(object):
+    """ Handle for a test submitted to a `StdinWorker`. Stands in for a `Popen`
+    object in the process info of the test runners. Only the wall time of a
+    job is known, since the process is shared by all jobs. A test file with 
+    several post-states produces one marker for each of them. Instead of the
+    path of the test file, the worker can be sent a json 'request', which gets
+    the 'prestate' added unless the worker just sent it (for the 'prestate_key')"""
+
+    def __init__(self, worker, testfile, posts = 1, request = None, prestate = None):
+        self.worker = worker
+        self.testfile = testfile
+        self.request = request
+        self.prestate = prestate
+        self.markers = posts
+        self.lines = queue.Queue()
+        self.finished = False
+        self.usage = None
+        self.started = time.time()
+        worker.submit(self)
+
+    def put(self, line):
+        self.lines.put(line)
+
+    def stream(self, timeout = 30):
+        """ Yields the output lines of the test, as they arrive. If the test 
+        does not complete in time, it is aborted"""
+        deadline = time.time() + timeout
+        while True:
+            try:
+                line = self.lines.get(timeout = max(0, deadline - time.time()))
+            except queue.Empty:
+                logger.info("TIMEOUT ERROR!")
+                self.abort()
+                return
+            if line is None:
+                self.finished = True
+                self.usage = Usage(time.time() - self.started, None, None, None)
+                return
+            yield line
+
+    def result(self, timeout = 30):
+        return list(self.stream(timeout))
+
+    def abort(self):
+        if not self.finished:
+            self.finished = True
+            self.worker.abort(self)
+
+
+class BatchRun(object):
+    """ Splits the output of a client executing all the post-states of a test 
+    file in one invocation into one `BatchJob` per post-state, switching to 
+    the next job whenever the end-of-test marker is seen. The jobs are meant 
+    to be read in order: reading a job first skips what is left of the jobs 
+    before it"""
+
+    def __init__(self, lines, posts, marker = '"stateRoot"'):
+        self.lines = iter(lines)
+        self.marker = marker
+        self.jobs = [BatchJob(self, i) for i in range(posts)]
+        self.last = time.time()
+
+    def _read(self, job):
+        """ Yields the lines of a job, from the shared output """
+        for previous in self.jobs[:job.index]:
+            previous._skip()
+        if job.done:
+            return
+        for line in self.lines:
+            yield line
+            if line.find(self.marker) != -1:
+                break
+        job.done = True
+        job.usage = Usage(time.time() - self.last, None, None, None)
+        self.last = time.time()
+        if job.index == len(self.jobs) - 1:
+            self.close()
+
+    def close(self):
+        """ Reads the output up to the end, so the process gets reaped """
+        for line in self.lines:
+            pass
+
+
+class BatchJob(object):
+    """ Handle for one post-state of a `BatchRun`. Stands in for a `Popen` 
+    object in the process info of the test runners. Only the wall time of a
+    job is known, measured from the end of the previous one"""
+
+    def __init__(self, run, index):
+        self.run = run
+        self.index = index
+        # all output of the job was read from the run
+        self.done = False
+        # the output of the job is no longer wanted
+        self.finished = False
+        self.usage = None
+
+    def _skip(self):
+        if not self.done:
+            for line in self.run._read(self):
+                pass
+
+    def stream(self, timeout = 30):
+        """ Yields the output lines of the post-state. The timeout is that of the
+        whole run, which is enforced by the underlying stream """
+        for line in self.run._read(self):
+            if self.finished:
+                return
+            yield line
+        self.finished = True
+
+    def result(self, timeout = 30):
+        return list(self.stream(timeout))
+
+    def abort(self):
+        """ Drops the rest of the output. The process is not killed, since it 
+        still has to execute the post-states after this one """
+        self.finished = True
+
+
+class ClientQueues(object):
+    """ Executes each test on all of its clients, with a queue per client which 
+    is served by that client's own number of threads, so a slow client does 
+    not hold up the others (until 'inflight' tests are waiting for it).
+    'execute(client, test)' returns the result of a client, None if it raises.
+    The results are joined by test key: once all the clients of a test are 
+    done, it can be taken from 'results' as (test, {client: result})"""
+
+    def __init__(self, execute, threads, inflight = 8):
+        self.execute = execute
+        self.queues = {}
+        # test key -> (test, results, clients not done yet)
+        self.pending = {}
+        self.completed = queue.Queue()
+        self.lock = threading.Lock()
+        self.window = threading.BoundedSemaphore(inflight)
+        self.threads = []
+        for (client, count) in threads.items():
+            self.queues[client] = queue.Queue()
+            for i in range(count):
+                t = threading.Thread(target = self._run, args = (client, self.queues[client]), 
+                    name = "%s-%d" % (client, i))
+                t.daemon = True
+                t.start()
+                self.threads.append((client, t))
+
+    def submit(self, key, test, clients):
+        """ Queues a test on the given clients. Blocks while 'inflight' tests are 
+        not complete yet """
+        self.window.acquire()
+        with self.lock:
+            self.pending[key] = (test, {}, set(clients))
+        for client in clients:
+            self.queues[client].put((key, test))
+
+    def _run(self, client, tests):
+        for (key, test) in iter(tests.get, None):
+            try:
+                result = self.execute(client, test)
+            except Exception as e:
+                logger.warning("Exception executing %s on %s: %s", key, client, e)
+                result = None
+            with self.lock:
+                (test, results, remaining) = self.pending[key]
+                results[client] = result
+                remaining.discard(client)
+                if not remaining:
+                    del self.pending[key]
+                    self.completed.put((test, results))
+                    self.window.release()
+
+    def results(self, block = False):
+        """ Yields the tests completed so far, or with 'block', until no test is
+        in flight anymore """
+        while True:
+            with self.lock:
+                waiting = len(self.pending)
+            try:
+                yield self.completed.get(block = block and waiting > 0, timeout = 1)
+            except queue.Empty:
+                if not block or waiting == 0:
+                    return
+
+    def backlog(self):
+        """ Returns the number of tests queued per client """
+        return dict((client, q.qsize()) for (client, q) in self.queues.items())
+
+    def stop(self):
+        for (client, t) in self.threads:
+            self.queues[client].put(None)
+        for (client, t) in self.threads:
+            t.join()
+
+
+class ProducerPool(object):
+    """ Runs 'produce' on a number of threads, feeding a bounded queue which 
+    is consumed by iterating over the pool. The producers block while the 
+    queue is full, so they never get more than 'prefetch' items ahead of the
+    consumer. When 'produce' fails (returns None or raises), that producer 
+    backs off for a while before trying again"""
+
+    def __init__(self, produce, num_workers = 1, prefetch = 8, backoff = 2, name = "tests"):
+        self.produce = produce
+        self.backoff = backoff
+        self.name = name
+        self.queue = queue.Queue(prefetch)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.produced = 0
+        self.failed = 0
+        self.consumed = 0
+        self.started = time.time()
+        self.threads = []
+        for i in range(max(1, num_workers)):
+            t = threading.Thread(target = self._run, name = "producer-%d" % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                item = self.produce()
+            except Exception as e:
+                logger.warning("Producer failed: %s", e)
+                item = None
+            if item is None:
+                with self.lock:
+                    self.failed = self.failed + 1
+                self.stopped.wait(self.backoff)
+                continue
+            with self.lock:
+                self.produced = self.produced + 1
+                if self.produced % 10 == 0:
+                    logger.info(self.report())
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(item, timeout = 1)
+                    break
+                except queue.Full:
+                    continue
+
+    def __iter__(self):
+        while not self.stopped.is_set():
+            item = self.queue.get()
+            with self.lock:
+                self.consumed = self.consumed + 1
+            yield item
+
+    def rate(self):
+        """ Items produced per second """
+        return self.produced / max(time.time() - self.started, 1e-9)
+
+    def report(self):
+        return "Generated {} {} ({} failed), generation speed: {:f} {}/s, {} ready".format(
+            self.produced, self.name, self.failed, self.rate(), self.name, self.queue.qsize())
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Minimizes a failing state test (e.g. a '<test id>-test.json' kept by
+trace_statetests_new.py), keeping only what is needed for the clients to
+still disagree the same way: the first trace difference must keep its
+signature (opcode, disagreeing clients, error class and diff kind).
+
+The clients are configured in statetests.ini, as for trace_statetests_new.py,
+and the candidates of each round are executed in parallel.
+
+    python3 minimize_statetest.py logs/0042-stRandom-randomStatetest-0-test.json
+"""
+import sys, json, argparse, multiprocessing
+import trace_statetests_new as runner
+from evmlab import minimize
+
+logger = runner.logger
+
+def main():
+    parser = argparse.ArgumentParser(description = "Minimizes a failing state test")
+    parser.add_argument("test", type = str, help = "State test with a single post-state")
+    parser.add_argument("output", type = str, nargs = "?", default = None,
+        help = "Where to write the minimized test (default <test>.min.json)")
+    parser.add_argument("-j", "--parallel", type = int, default = max(runner.cfg['PARALLEL'], 1),
+        help = "Number of candidates executed concurrently")
+    parser.add_argument("--any", action = "store_true",
+        help = "Accept any difference, not only one with the original signature")
+    parser.add_argument("--rounds", type = int, default = 5)
+    options = parser.parse_args()
+
+    with open(options.test) as f:
+        statetest = json.load(f)
+
+    original = runner.signatureOf(statetest)
+    if original is None:
+        logger.warning("The clients agree on %s, nothing to minimize", options.test)
+        return 1
+    logger.info("Signature of %s: %s", options.test, original)
+
+    # the pool processes share the spool, but start their own client workers
+    runner.stopWorkers()
+    counter = multiprocessing.Value('i', 0)
+    pool = multiprocessing.Pool(options.parallel, runner.init_pool_worker, (counter,))
+
+    def check(candidates):
+        signatures = pool.map(runner.signatureOf, candidates)
+        if options.any:
+            return [s is not None for s in signatures]
+        return [s == original for s in signatures]
+
+    minimizer = minimize.StateTestMinimizer(statetest, check, options.rounds)
+    minimized = minimizer.run()
+    pool.close()
+    pool.join()
+
+    output = options.output
+    if output is None:
+        output = "%s.min.json" % (options.test[:-5] if options.test.endswith(".json") else options.test)
+    with open(output, "w") as f:
+        json.dump(minimized, f, indent = 2)
+    logger.info("Minimized test written to %s", output)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
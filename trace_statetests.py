@@ -12,6 +12,10 @@ from ethereum.utils import decode_hex, parse_int_or_hex, sha3, to_string, \
 from evmlab import genesis as gen
 from evmlab import vm as VMUtils
 from evmlab import opcodes
+from evmlab import resultcache
+from evmlab import ledger as runledger
+from evmlab import catalog as testcatalog
+from evmlab import scheduler
 
 import logging
 logger = logging.getLogger()
@@ -54,6 +58,30 @@ def parse_config():
 
     cfg['LOGS_PATH'] = config[uname]['logs_path']
 
+    # Ledger recording the executed tests. 'resume' continues the last run in the 
+    # ledger, 'rerun_failures' runs only the tests which failed in the last run
+    cfg['LEDGER'] = config[uname].get('ledger', None)
+    cfg['RESUME'] = config[uname].get('resume', 'No') == 'Yes'
+    cfg['RERUN_FAILURES'] = config[uname].get('rerun_failures', 'No') == 'Yes'
+
+    # Catalog of the test files, which tests are selected from without parsing 
+    # them. 'shard = i/n' runs only the i:th of n disjoint parts of the tests
+    cfg['CATALOG'] = config[uname].get('catalog', None)
+    cfg['CATALOG_UPDATE'] = config[uname].get('catalog_update', 'Yes') == 'Yes'
+    cfg['SHARD'] = tuple(int(x) for x in config[uname].get('shard', '0/1').split('/'))
+
+    # Order of the tests by their duration in earlier runs (none, longest or 
+    # shortest first), and timeouts of 'timeout_factor' times the longest 
+    # duration seen. Both need the ledger
+    cfg['SCHEDULE'] = config[uname].get('schedule', scheduler.NONE)
+    cfg['TIMEOUT_FACTOR'] = float(config[uname].get('timeout_factor', 3))
+    cfg['MIN_TIMEOUT'] = float(config[uname].get('min_timeout', 5))
+
+    # Cache of results per (test content, client binary/image, fork): clients 
+    # with a cached result are not executed, their trace digests are compared
+    cfg['RESULT_CACHE'] = config[uname].get('result_cache', None)
+    cfg['DIGEST_INTERVAL'] = int(config[uname].get('digest_interval', 1000))
+
     logger.info("Config")
     logger.info("\tActive clients:")
     for c in cfg['DO_CLIENTS']:
@@ -66,6 +94,13 @@ def parse_config():
     logger.info("\tPrestate tempfile:    %s",   cfg['PRESTATE_TMP_FILE'])
     logger.info("\tSingle test tempfile: %s",cfg['SINGLE_TEST_TMP_FILE'])
     logger.info("\tLog path:             %s",            cfg['LOGS_PATH'])
+    logger.info("\tTest catalog:         %s (update %s, shard %d/%d)", 
+        cfg['CATALOG'], cfg['CATALOG_UPDATE'], cfg['SHARD'][0], cfg['SHARD'][1])
+    logger.info("\tSchedule:             %s (timeouts %.1f x history, min %.1fs)", 
+        cfg['SCHEDULE'], cfg['TIMEOUT_FACTOR'], cfg['MIN_TIMEOUT'])
+    logger.info("\tRun ledger:           %s (resume %s, rerun failures %s)", 
+        cfg['LEDGER'], cfg['RESUME'], cfg['RERUN_FAILURES'])
+    logger.info("\tResult cache:         %s",         cfg['RESULT_CACHE'])
 
 
 
@@ -106,10 +141,30 @@ def iterate_tests(path = '/GeneralStateTests/', ignore = []):
     for subdir, dirs, files in sorted(os.walk(cfg['TESTS_PATH'] + path)):
         for f in files:
             if f.endswith('json'):
-                for ignore_name in ignore:
-                    if f.find(ignore_name) != -1:
-                        continue
-                    yield os.path.join(subdir, f)
+                if any(f.find(ignore_name) != -1 for ignore_name in ignore):
+                    continue
+                yield os.path.join(subdir, f)
+
+def catalog_tests(path = '/GeneralStateTests/', ignore = []):
+    """ Yields the (file, test name) of the tests selected from the catalog, 
+    which is brought up to date first (unless 'catalog_update' is disabled) """
+    root = os.path.normpath(cfg['TESTS_PATH'] + path)
+    catalog = testcatalog.TestCatalog(cfg['CATALOG'])
+    if cfg['CATALOG_UPDATE']:
+        catalog.update(root)
+    entries = catalog.select(cfg['FORK_CONFIG'], root, skip = SKIP_LIST, skip_patterns = regex_skip,
+        whitelist = TEST_WHITELIST, ignore = ignore, shard = cfg['SHARD'])
+    (num_tests, size) = catalog.cost(entries, cfg['FORK_CONFIG'])
+    logger.info("Selected %d files with %d tests (%d bytes) from the catalog", len(entries), num_tests, size)
+    if cost_model is not None:
+        def cost(entry):
+            return sum(cost_model.cost(testKey(entry.subfolder, entry.name, i)) 
+                for i in range(entry.posts[cfg['FORK_CONFIG']]))
+        entries = scheduler.order(entries, cost, cfg['SCHEDULE'])
+        logger.info("Estimated duration: %.1fs", sum(cost(e) for e in entries))
+    catalog.close()
+    for entry in entries:
+        yield (entry.path, entry.name)
 
 
 def convertGeneralTest(test_file, fork_name):
@@ -442,38 +497,93 @@ SKIP_LIST = [
 regex_skip = [skip.replace('*', '') for skip in SKIP_LIST if '*' in skip]
 
 
+# Run ledger, and the keys of the tests to skip (when resuming) or to 
+# run exclusively (when re-running failures)
+ledger = None
+DONE_KEYS = set()
+RERUN_KEYS = None
+# Durations of the tests in earlier runs
+cost_model = None
+
+def openLedger():
+    global ledger, DONE_KEYS, RERUN_KEYS, cost_model
+    if not cfg['LEDGER']:
+        return
+    ledger = runledger.RunLedger(cfg['LEDGER'])
+    cost_model = scheduler.CostModel(ledger.durations(), 
+        factor = cfg['TIMEOUT_FACTOR'], minimum = cfg['MIN_TIMEOUT'])
+    if cfg['RERUN_FAILURES']:
+        RERUN_KEYS = set(key for (key, test_id, artifacts) in ledger.failures())
+        logger.info("Re-running %d failures of run %s", len(RERUN_KEYS), ledger.lastRun())
+    if cfg['RESUME'] and not cfg['RERUN_FAILURES']:
+        DONE_KEYS = ledger.resumeRun(cfg['DO_CLIENTS'], cfg['FORK_CONFIG'])
+    else:
+        ledger.startRun(cfg['DO_CLIENTS'], cfg['FORK_CONFIG'])
+
+# Result cache, see 'result_cache'
+result_cache = None
+
+def openResultCache():
+    global result_cache
+    if cfg['RESULT_CACHE']:
+        result_cache = resultcache.ResultCache(cfg['RESULT_CACHE'])
+
+def cacheKey(content_hash, client_name):
+    """ Returns the result cache key for running a test on a client """
+    return (content_hash, resultcache.clientDigest(*getBaseCmd(client_name)), cfg['FORK_CONFIG'])
 
-# to resume running after interruptions
-START_I = 0
+# Resources used per client, summarized at the end of the run
+usage_stats = VMUtils.UsageStats()
+
+def testKey(test_subfolder, test_name, tx_i):
+    """ Identifies a test in the ledger, independent of its position in the run """
+    return "{}/{}/{}".format(test_subfolder, test_name, tx_i)
+
+def clientTimeout(client_name, test_key):
+    """ Seconds a client gets to execute a test """
+    default = 45 if client_name == "py" else 30
+    if cost_model is None:
+        return default
+    return cost_model.timeout(client_name, test_key, default)
 
 
 def testIterator():
+    """ Yields (file, test name) tuples, where the name is None if not known yet """
     if cfg['RANDOM_TESTS'] == 'Yes':
         logger.info("generating random tests...")
-        return generateTests()
+        return ((f, None) for f in generateTests())
+    elif cfg['CATALOG']:
+        logger.info("iterating over state tests in the catalog...")
+        return catalog_tests(ignore=['stMemoryTest'])
     else:
         logger.info("iterating over state tests...")
-        return iterate_tests(ignore=['stMemoryTest','stMemoryTest','stMemoryTest'])
+        return ((f, None) for f in iterate_tests(ignore=['stMemoryTest']))
 
 
 def main():
+    openLedger()
+    openResultCache()
     fail_count = 0
     pass_count = 0
     failing_files = []
     test_number = 0
     start_time = time.time()
-    for f in testIterator():
-        with open(f) as json_data:
-            general_test = json.load(json_data)
-            test_name = list(general_test.keys())[0]
-            if TEST_WHITELIST and test_name not in TEST_WHITELIST:
-                continue
-            if test_name in SKIP_LIST and test_name not in TEST_WHITELIST:
-                logger.info("skipping test: %s" % test_name)
-                continue
-            if regex_skip and re.search('|'.join(regex_skip), test_name) and test_name not in TEST_WHITELIST:
-                logger.info("skipping test (regex match): %s" % test_name)
-                continue
+    for (f, test_name) in testIterator():
+        if test_name is None:
+            with open(f) as json_data:
+                general_test = json.load(json_data)
+                test_name = list(general_test.keys())[0]
+        if TEST_WHITELIST and test_name not in TEST_WHITELIST:
+            continue
+        if test_name in SKIP_LIST and test_name not in TEST_WHITELIST:
+            logger.info("skipping test: %s" % test_name)
+            continue
+        if regex_skip and re.search('|'.join(regex_skip), test_name) and test_name not in TEST_WHITELIST:
+            logger.info("skipping test (regex match): %s" % test_name)
+            continue
+        if RERUN_KEYS is not None and not any(key.startswith(testKey(f.split(os.sep)[-2], test_name, ''))
+                for key in RERUN_KEYS):
+            continue
 
 
         (test_number, num_fails, num_passes,failures) = perform_test(f, test_name, test_number)
@@ -500,30 +610,38 @@ def main():
     logger.info("fail_count: %d" % fail_count)
     logger.info("pass_count: %d" % pass_count)
     logger.info("total:      %d" % (fail_count + pass_count))
+    for line in usage_stats.summary():
+        logger.info(line)
+    if ledger is not None:
+        ledger.close()
+    if result_cache is not None:
+        result_cache.close()
 
 
 def finishProc(name, processInfo, canonicalizer, fulltrace_filename = None):
     """ Ends the process, returns the canonical trace and also writes the 
     full process output to a file, along with the command used to start the process"""
 
-    process = processInfo['proc']
-
-    extraTime = False
-    if name == "py":
-        extraTime = True
-
-    outp = VMUtils.finishProc(processInfo['proc'], extraTime, processInfo['output'])
+    timeout = processInfo.get('timeout', 45 if name == "py" else 30)
+    outp = VMUtils.streamProc(processInfo['proc'], output = processInfo['output'], timeout = timeout)
 
-    if fulltrace_filename is not None:
+    if fulltrace_filename is None:
+        canon_steps = list(canonicalizer(outp))
+    else:
         #logging.info("Writing %s full trace to %s" % (name, fulltrace_filename))
         with open(fulltrace_filename, "w+") as f: 
             f.write("# command\n")
             f.write("# %s\n\n" % processInfo['cmd'])
-            f.write("\n".join(outp))
 
-    canon_text = [toText(step) for step in canonicalizer(outp)]
-    logging.info("Processed %s steps for %s" % (len(canon_text), name))
-    return canon_text
+            def tee(lines):
+                for line in lines:
+                    f.write(line)
+                    f.write("\n")
+                    yield line
+
+            canon_steps = list(canonicalizer(tee(outp)))
+    logging.info("Processed %s steps for %s" % (len(canon_steps), name))
+    return canon_steps
 
 def get_summary(combined_trace, n=20):
     """Returns (up to) n (default 20) preceding steps before the first diff, and the diff-section
@@ -543,6 +661,53 @@ def get_summary(combined_trace, n=20):
     return list(buf)
 
 
+canonicalizers = {
+    "geth" : VMUtils.GethVM.canonicalSteps, 
+    "cpp"  : VMUtils.CppVM.canonicalSteps, 
+    "py"   : VMUtils.PyVM.canonicalSteps, 
+    "parity"  :  VMUtils.ParityVM.canonicalSteps ,
+}
+
+def run_clients(test_id, test_key, test_subfolder, test_name, tx, tx_dgv, clients, traces, traceFiles, usage):
+    """ Executes the test on the clients, and adds their canonical traces to 'traces', 
+    the full trace files to 'traceFiles' and the resources used to 'usage' """
+    test_tmpfile     = cfg['SINGLE_TEST_TMP_FILE']
+    prestate_tmpfile = cfg['PRESTATE_TMP_FILE']
+    procs = []
+
+    logger.info("Starting processes for %s" % clients)
+
+    #Start the processes
+    for client_name in clients:
+
+        if client_name == 'geth':
+            procinfo = startGeth(test_tmpfile)
+        elif client_name == 'cpp':
+            procinfo = startCpp(test_subfolder, test_name, tx_dgv)
+        elif client_name == 'py':
+            procinfo = startPython(prestate_tmpfile, tx)
+        elif client_name == 'parity':
+            procinfo = startParity(test_tmpfile)
+        else:
+            logger.warning("Undefined client %s", client_name)
+            continue
+        procinfo['timeout'] = clientTimeout(client_name, test_key)
+        procs.append( (procinfo, client_name ))
+
+    # Read the outputs
+    for (procinfo, client_name) in procs:
+        if procinfo['proc'] is None:
+            continue
+
+        canonicalizer = canonicalizers[client_name]
+        full_trace_filename = os.path.abspath("%s/%s-%s.trace.log" % (cfg['LOGS_PATH'],test_id, client_name))
+        traceFiles.append(full_trace_filename)
+        canon_trace = finishProc(client_name, procinfo, canonicalizer, full_trace_filename)
+        traces[client_name] = canon_trace
+        if hasattr(procinfo['proc'], 'usage'):
+            usage[client_name] = procinfo['proc'].usage
+
+
 def perform_test(testfile, test_name, test_number = 0):
 
     logger.info("file: %s, test name %s " % (testfile,test_name))
@@ -570,60 +735,61 @@ def perform_test(testfile, test_name, test_number = 0):
 
     for tx_i, tx_and_dgv in enumerate(txs_dgv):
         test_number += 1
-        if test_number < START_I and not TEST_WHITELIST:
+        test_key = testKey(test_subfolder, test_name, tx_i)
+        if test_key in DONE_KEYS and not TEST_WHITELIST:
+            continue
+        if RERUN_KEYS is not None and test_key not in RERUN_KEYS:
             continue
 
         test_id = "{:0>4}-{}-{}-{}".format(test_number,test_subfolder,test_name,tx_i)
         logger.info("test id: %s" % test_id)
+        test_started = time.time()
 
-        single_statetest = selectSingleFromGeneral(tx_i, testfile, fork_name)
+        single_statetest_json = json.dumps(selectSingleFromGeneral(tx_i, testfile, fork_name))
         with open(test_tmpfile, 'w') as outfile:
-            json.dump(single_statetest, outfile)
+            outfile.write(single_statetest_json)
+        content_hash = resultcache.contentHash(single_statetest_json)
 
         tx = tx_and_dgv[0]
         tx_dgv = tx_and_dgv[1]
 
+        # Trace digests of the clients with a cached result, which are not executed
+        cached = {}
+        if result_cache is not None:
+            for client_name in clients:
+                digest = result_cache.get(*cacheKey(content_hash, client_name))
+                if digest is not None:
+                    logger.info("Using cached result for %s", client_name)
+                    cached[client_name] = digest
 
-        clients_canon_traces = []
-        procs = []
-
-        canonicalizers = {
-            "geth" : VMUtils.GethVM.canonicalized, 
-            "cpp"  : VMUtils.CppVM.canonicalized, 
-            "py"   : VMUtils.PyVM.canonicalized, 
-            "parity"  :  VMUtils.ParityVM.canonicalized ,
-        }
-        logger.info("Starting processes for %s" % clients)
-
-        #Start the processes
-        for client_name in clients:
-
-            if client_name == 'geth':
-                procinfo = startGeth(test_tmpfile)
-            elif client_name == 'cpp':
-                procinfo = startCpp(test_subfolder, test_name, tx_dgv)
-            elif client_name == 'py':
-                procinfo = startPython(prestate_tmpfile, tx)
-            elif client_name == 'parity':
-                procinfo = startParity(test_tmpfile)
-            else:
-                logger.warning("Undefined client %s", client_name)
-                continue
-            procs.append( (procinfo, client_name ))
-
+        traces = {}
         traceFiles = []
-        # Read the outputs
-        for (procinfo, client_name) in procs:
-            if procinfo['proc'] is None:
-                continue
-
-            canonicalizer = canonicalizers[client_name]
-            full_trace_filename = os.path.abspath("%s/%s-%s.trace.log" % (cfg['LOGS_PATH'],test_id, client_name))
-            traceFiles.append(full_trace_filename)
-            canon_trace = finishProc(client_name, procinfo, canonicalizer, full_trace_filename)
-            clients_canon_traces.append(canon_trace)
+        usage = {}
+        run_clients(test_id, test_key, test_subfolder, test_name, tx, tx_dgv, 
+            [c for c in clients if c not in cached], traces, traceFiles, usage)
+
+        if cached:
+            digests = dict((c, VMUtils.TraceDigest(cfg['DIGEST_INTERVAL']).fold(trace)) for (c, trace) in traces.items())
+            digests.update(cached)
+            (equivalent, start) = VMUtils.compare_digests([digests[c] for c in clients if c in digests])
+            if not equivalent:
+                logger.info("Trace digest mismatch with the cached results, re-running %s with full traces", 
+                    ", ".join(cached))
+                run_clients(test_id, test_key, test_subfolder, test_name, tx, tx_dgv, 
+                    list(cached), traces, traceFiles, usage)
+        usage_stats.update(usage)
+
+        if cached and equivalent:
+            trace_output = []
+        else:
+            names = [c for c in clients if c in traces]
+            (equivalent, trace_output) = VMUtils.compare_traces([traces[c] for c in names], names) 
 
-        (equivalent, trace_output) = VMUtils.compare_traces(clients_canon_traces, clients) 
+        if equivalent and result_cache is not None:
+            # Only results the clients agree on are cached
+            for (client_name, trace) in traces.items():
+                result_cache.put(*cacheKey(content_hash, client_name), client = client_name, 
+                    trace_digest = VMUtils.TraceDigest(cfg['DIGEST_INTERVAL']).fold(trace))
 
         if equivalent:
             #delete non-failed traces
@@ -632,6 +798,7 @@ def perform_test(testfile, test_name, test_number = 0):
 
             pass_count += 1
             passfail = 'PASS'
+            artifacts = []
         else:
             logger.warning("CONSENSUS BUG!!!")
             failures.append(test_name)
@@ -639,6 +806,7 @@ def perform_test(testfile, test_name, test_number = 0):
             # save the state-test
             statetest_filename = "%s/%s-test.json" %(cfg['LOGS_PATH'], test_id)
             os.rename(test_tmpfile,statetest_filename)
+            artifacts = [os.path.abspath(statetest_filename)] + traceFiles
 
             # save combined trace
             passfail = 'FAIL'
@@ -653,6 +821,11 @@ def perform_test(testfile, test_name, test_number = 0):
             with open(summary_log_filename, "w+") as f:
                 logger.info("Summary trace: %s" , summary_log_filename)
                 f.write("\n".join(trace_summary))
+            artifacts.extend([os.path.abspath(passfail_log_filename), os.path.abspath(summary_log_filename)])
+
+        if ledger is not None:
+            ledger.record(test_key, test_id, clients, passfail, test_started, 
+                time.time() - test_started, artifacts, usage)
 
 
     return (test_number, len(failures), pass_count, failures)
@@ -3,7 +3,7 @@
 Executes state tests on multiple clients, checking for EVM trace equivalence
 
 """
-import json, sys, re, os, subprocess, io, itertools, traceback, time, collections
+import json, sys, re, os, subprocess, io, itertools, traceback, time, collections, signal, random, copy, threading
 from contextlib import redirect_stderr, redirect_stdout
 import ethereum.transactions as transactions
 from ethereum.utils import decode_hex, parse_int_or_hex, sha3, to_string, \
@@ -12,6 +12,15 @@ from ethereum.utils import decode_hex, parse_int_or_hex, sha3, to_string, \
 from evmlab import genesis as gen
 from evmlab import vm as VMUtils
 from evmlab import opcodes
+from evmlab import workers
+from evmlab import resultcache
+from evmlab import ledger as runledger
+from evmlab import scheduler
+from evmlab import randomtest
+from evmlab import pyeth
+from evmlab import campaign
+from evmlab import buckets
+from evmlab import health
 
 import logging
 logger = logging.getLogger()
@@ -54,18 +63,125 @@ def parse_config():
 
     cfg['LOGS_PATH'] = config[uname]['logs_path']
 
+    # Keep one warm container / process per client, instead of one per test
+    cfg['PERSISTENT_WORKERS'] = config[uname].get('persistent_workers', 'No') == 'Yes'
+
+    # Compare the clients step by step while they run, and stop them shortly 
+    # after the first difference
+    cfg['LOCKSTEP'] = config[uname].get('lockstep', 'No') == 'Yes'
+    cfg['LOCKSTEP_TAIL'] = int(config[uname].get('lockstep_tail', 20))
+
+    # First compare only the final stateRoots, and re-run with full traces on mismatch
+    cfg['TWO_PHASE'] = config[uname].get('two_phase', 'No') == 'Yes'
+
+    # First compare rolling digests of the canonical traces, and re-run with full 
+    # traces on mismatch. Takes precedence over 'two_phase'
+    cfg['DIGEST'] = config[uname].get('digest', 'No') == 'Yes'
+    cfg['DIGEST_INTERVAL'] = int(config[uname].get('digest_interval', 1000))
+
+    # Persistent cache of results per (test, client binary, fork). Implies digest mode
+    cfg['RESULT_CACHE'] = config[uname].get('result_cache', None)
+    if cfg['RESULT_CACHE']:
+        cfg['DIGEST'] = True
+
+    # Failures grouped by the signature of their first difference, shared by the 
+    # test processes. Only the first 'bucket_keep' failures per bucket keep artifacts
+    cfg['FAILURE_BUCKETS'] = config[uname].get('failure_buckets', None)
+    cfg['BUCKET_KEEP'] = int(config[uname].get('bucket_keep', 5))
+
+    # Re-run the clients which disagree on a test 'flaky_reruns' times before
+    # recording a failure. Failures reproduced by less than 'flaky_min_rate' of
+    # the re-runs are recorded as flaky
+    cfg['FLAKY_RERUNS'] = int(config[uname].get('flaky_reruns', 0))
+    cfg['FLAKY_MIN_RATE'] = float(config[uname].get('flaky_min_rate', 1.0))
+
+    # Eject a client after 'eject_after' consecutive crashes, timeouts or empty 
+    # traces (0: never), and probe it every 'probe_interval' seconds until it works
+    cfg['EJECT_AFTER'] = int(config[uname].get('eject_after', 0))
+    cfg['PROBE_INTERVAL'] = float(config[uname].get('probe_interval', 60))
+
+    # Execute all post-states of a test with one invocation of the clients
+    # which support it (geth, parity), splitting their output per post-state
+    cfg['BATCH'] = config[uname].get('batch', 'No') == 'Yes'
+
+    # Ledger recording the executed tests. 'resume' continues the last run in the 
+    # ledger, 'rerun_failures' runs only the tests which failed in the last run
+    cfg['LEDGER'] = config[uname].get('ledger', None)
+    cfg['RESUME'] = config[uname].get('resume', 'No') == 'Yes'
+    cfg['RERUN_FAILURES'] = config[uname].get('rerun_failures', 'No') == 'Yes'
+
+    # Order of a finite set of tests (e.g. 'rerun_failures') by their duration in
+    # earlier runs (none, longest or shortest first), and timeouts of 'timeout_factor'
+    # times the longest duration seen. Both need the ledger
+    cfg['SCHEDULE'] = config[uname].get('schedule', scheduler.NONE)
+    cfg['TIMEOUT_FACTOR'] = float(config[uname].get('timeout_factor', 3))
+    cfg['MIN_TIMEOUT'] = float(config[uname].get('min_timeout', 5))
+
+    # Number of threads generating random tests in the background, and how many
+    # generated tests may be waiting to be executed
+    cfg['GENERATORS'] = int(config[uname].get('generators', 1))
+    cfg['PREFETCH'] = int(config[uname].get('prefetch', 8))
+
+    # Random tests come from testeth, or from the in-process generator, which is
+    # reproducible: test i of a seed is always the same, or from a coverage-guided 
+    # campaign on pyeth, which mutates the tests that reached new code
+    cfg['GENERATOR'] = config[uname].get('generator', 'testeth')
+    seed = config[uname].get('generator_seed', '')
+    cfg['GENERATOR_SEED'] = int(seed) if seed else random.randrange(2**32)
+    cfg['COVERAGE_CORPUS'] = config[uname].get('coverage_corpus', None)
+    cfg['COVERAGE_MUTATE'] = float(config[uname].get('coverage_mutate', 0.8))
+
+    # Number of tests to run concurrently, and how many may be queued up for the workers
+    cfg['PARALLEL'] = int(config[uname].get('parallel', 1))
+    cfg['INFLIGHT'] = int(config[uname].get('inflight', 2 * cfg['PARALLEL']))
+
+    # Execute the tests with a queue per client, served by '<client>.workers' 
+    # threads, comparing each test once all clients are done with it
+    cfg['CLIENT_QUEUES'] = config[uname].get('client_queues', 'No') == 'Yes'
+    cfg['QUEUE_THREADS'] = dict((c, int(local_cfg["%s.workers" % c] or 1)) for c in cfg['DO_CLIENTS'])
+    if local_cfg["py.in_process"] == 'Yes' and cfg['QUEUE_THREADS'].get('py', 1) > 1:
+        # the executor runs one test at a time
+        logger.warning("In-process pyethereum uses a single worker")
+        cfg['QUEUE_THREADS']['py'] = 1
+
     logger.info("Config")
     logger.info("\tActive clients:")
     for c in cfg['DO_CLIENTS']:
+        if c == 'py' and local_cfg["py.in_process"] == 'Yes':
+            logger.info("\t* py : in-process %s", local_cfg["py.runner"] or pyeth.DEFAULT_RUNNER)
+            continue
         logger.info("\t* {} : {} docker:{}".format(c, getBaseCmd(c)[0],getBaseCmd(c)[1]) )
 
     logger.info("\tTest generator:")
-    logger.info("\t* {} : {} docker:{}".format('testeth', getBaseCmd('testeth')[0],getBaseCmd('testeth')[1]) )
+    if cfg['GENERATOR'] == 'native':
+        logger.info("\t* native : seed %d", cfg['GENERATOR_SEED'])
+    elif cfg['GENERATOR'] == 'coverage':
+        logger.info("\t* coverage : seed %d, corpus %s, mutate %.2f", cfg['GENERATOR_SEED'], 
+            cfg['COVERAGE_CORPUS'], cfg['COVERAGE_MUTATE'])
+    else:
+        logger.info("\t* {} : {} docker:{}".format('testeth', getBaseCmd('testeth')[0],getBaseCmd('testeth')[1]) )
  
     logger.info("\tFork config:          %s",         cfg['FORK_CONFIG'])
     logger.info("\tPrestate tempfile:    %s",   cfg['PRESTATE_TMP_FILE'])
     logger.info("\tSingle test tempfile: %s",cfg['SINGLE_TEST_TMP_FILE'])
     logger.info("\tLog path:             %s",            cfg['LOGS_PATH'])
+    logger.info("\tPersistent workers:   %s",   cfg['PERSISTENT_WORKERS'])
+    logger.info("\tLock-step compare:    %s (tail %d)", cfg['LOCKSTEP'], cfg['LOCKSTEP_TAIL'])
+    logger.info("\tTwo-phase (roots):    %s",            cfg['TWO_PHASE'])
+    logger.info("\tTrace digests:        %s (interval %d)", cfg['DIGEST'], cfg['DIGEST_INTERVAL'])
+    logger.info("\tResult cache:         %s",         cfg['RESULT_CACHE'])
+    logger.info("\tFailure buckets:      %s (artifacts of %d per bucket)", cfg['FAILURE_BUCKETS'], cfg['BUCKET_KEEP'])
+    logger.info("\tFlaky re-runs:        %d (stable at %.2f)", cfg['FLAKY_RERUNS'], cfg['FLAKY_MIN_RATE'])
+    logger.info("\tEject clients after:  %d failures (probe every %ds)", cfg['EJECT_AFTER'], cfg['PROBE_INTERVAL'])
+    logger.info("\tBatch mode:           %s",                cfg['BATCH'])
+    logger.info("\tSchedule:             %s (timeouts %.1f x history, min %.1fs)", 
+        cfg['SCHEDULE'], cfg['TIMEOUT_FACTOR'], cfg['MIN_TIMEOUT'])
+    logger.info("\tRun ledger:           %s (resume %s, rerun failures %s)", 
+        cfg['LEDGER'], cfg['RESUME'], cfg['RERUN_FAILURES'])
+    logger.info("\tTest generators:      %d (prefetch %d)", cfg['GENERATORS'], cfg['PREFETCH'])
+    logger.info("\tParallel tests:       %d (in flight %d)", cfg['PARALLEL'], cfg['INFLIGHT'])
+    logger.info("\tClient queues:        %s (workers %s)", cfg['CLIENT_QUEUES'], 
+        ", ".join("%s:%d" % (c, n) for (c, n) in sorted(cfg['QUEUE_THREADS'].items())))
 
 
 
@@ -87,6 +203,183 @@ def getBaseCmd(bin_or_docker):
         
 parse_config()
 
+# Spool directory and per-client workers, used when 'persistent_workers' is enabled
+spool = None
+client_workers = {}
+# workers are also requested from the threads of the client queues
+client_workers_lock = threading.Lock()
+
+def getSpool():
+    global spool
+    if spool is None:
+        spool = workers.Spool()
+        logger.info("Spooling tests to %s", spool.path)
+    return spool
+
+def getWorker(client, mounts = None):
+    """ Returns the (started) persistent worker for a client. Docker clients get a warm
+    container, binaries configured with '<client>.stdin_worker = Yes' a long-lived process,
+    and pyeth with 'py.server = Yes' a long-lived runner reading requests on stdin """
+    with client_workers_lock:
+        if client not in client_workers:
+            client_workers[client] = startWorker(client, mounts)
+        return client_workers[client]
+
+def startWorker(client, mounts):
+    (name, isDocker) = getBaseCmd(client)
+    if client == 'py' and local_cfg["py.server"] == 'Yes':
+        # pyeth run_statetest.py in server mode, reading json requests on stdin
+        if isDocker:
+            cmd = ["docker", "run", "--rm", "-i", name, "run_statetest.py", "--server"]
+        else:
+            cmd = [name, "--server"]
+        worker = workers.StdinWorker(cmd, output = "stdout", marker = '"done"')
+    elif isDocker:
+        worker = workers.DockerWorker(name, mounts).start()
+    elif local_cfg["%s.stdin_worker" % client] == 'Yes':
+        worker = workers.StdinWorker([name, "--json", "--nomemory", "statetest"])
+    else:
+        worker = None
+    return worker
+
+def stopWorkers():
+    for worker in client_workers.values():
+        if worker is not None:
+            worker.stop()
+    client_workers.clear()
+
+# Result cache, opened per process
+result_cache = None
+
+def getResultCache():
+    global result_cache
+    if not cfg['RESULT_CACHE']:
+        return None
+    if result_cache is None or result_cache.pid != os.getpid():
+        result_cache = resultcache.ResultCache(cfg['RESULT_CACHE'])
+        result_cache.pid = os.getpid()
+    return result_cache
+
+def closeResultCache():
+    if result_cache is not None and result_cache.pid == os.getpid():
+        result_cache.close()
+
+# Failure buckets, opened per process
+failure_buckets = None
+
+def getBuckets():
+    global failure_buckets
+    if not cfg['FAILURE_BUCKETS']:
+        return None
+    if failure_buckets is None or failure_buckets.pid != os.getpid():
+        failure_buckets = buckets.FailureBuckets(cfg['FAILURE_BUCKETS'], cfg['BUCKET_KEEP'])
+        failure_buckets.pid = os.getpid()
+    return failure_buckets
+
+def closeBuckets():
+    if failure_buckets is not None and failure_buckets.pid == os.getpid():
+        failure_buckets.close()
+
+def reportBuckets():
+    if getBuckets() is not None:
+        for line in getBuckets().summary():
+            logger.info(line)
+
+# Health of the clients, tracked per process
+client_health = None
+
+def getHealth():
+    global client_health
+    if client_health is None or client_health.pid != os.getpid():
+        client_health = health.ClientHealth(cfg['DO_CLIENTS'], cfg['EJECT_AFTER'], 
+            probeClient, cfg['PROBE_INTERVAL'])
+        client_health.pid = os.getpid()
+    return client_health
+
+def closeHealth():
+    if client_health is not None and client_health.pid == os.getpid():
+        client_health.stop()
+
+def reportHealth():
+    if client_health is not None and client_health.pid == os.getpid() and client_health.counts:
+        for line in client_health.summary():
+            logger.info(line)
+
+# pyethereum executor, loaded once per process with 'py.in_process = Yes'
+pyeth_executor = None
+
+def getPyeth():
+    global pyeth_executor
+    if pyeth_executor is None or pyeth_executor.pid != os.getpid():
+        pyeth_executor = pyeth.PyethExecutor(local_cfg["py.runner"] or pyeth.DEFAULT_RUNNER)
+        pyeth_executor.pid = os.getpid()
+    return pyeth_executor
+
+# Run ledger, only written by the main process
+ledger = None
+# Durations of the tests in earlier runs
+cost_model = None
+
+def openLedger():
+    """ Opens the ledger and starts a run, or resumes the last one. Returns 
+    the keys of the tests which are already done, and the failures of the 
+    last run if only those should be re-run """
+    global ledger, cost_model
+    done = set()
+    failures = None
+    if not cfg['LEDGER']:
+        return (done, failures)
+    ledger = runledger.RunLedger(cfg['LEDGER'])
+    cost_model = scheduler.CostModel(ledger.durations(), 
+        factor = cfg['TIMEOUT_FACTOR'], minimum = cfg['MIN_TIMEOUT'])
+    if cfg['RERUN_FAILURES']:
+        failures = scheduler.order(ledger.failures(), lambda f: cost_model.cost(f[0]), cfg['SCHEDULE'])
+        logger.info("Re-running %d failures of run %s", len(failures), ledger.lastRun())
+    if cfg['RESUME'] and not cfg['RERUN_FAILURES']:
+        done = ledger.resumeRun(cfg['DO_CLIENTS'], cfg['FORK_CONFIG'])
+    else:
+        ledger.startRun(cfg['DO_CLIENTS'], cfg['FORK_CONFIG'])
+    return (done, failures)
+
+# Resources used per client, summarized at the end of the run
+usage_stats = VMUtils.UsageStats()
+
+def recordTest(test_key, test_id, outcome, started, duration, artifacts = None, usage = None, 
+        reproduced = None, clients = None):
+    usage_stats.update(usage)
+    if ledger is not None:
+        ledger.record(test_key, test_id, clients or cfg['DO_CLIENTS'], outcome, started, duration, 
+            artifacts, usage, reproduced)
+
+def reportUsage():
+    for line in usage_stats.summary():
+        logger.info(line)
+
+def clientTimeout(client_name, test):
+    """ Seconds a client gets to execute a test """
+    default = 45 if client_name == "py" else 30
+    if cost_model is None:
+        return default
+    return cost_model.timeout(client_name, test.key(), default)
+
+def closeLedger():
+    global ledger
+    if ledger is not None:
+        ledger.close()
+        ledger = None
+
+def cleanup():
+    closeHealth()
+    stopWorkers()
+    closeResultCache()
+    closeBuckets()
+    closeLedger()
+    if spool is not None:
+        spool.cleanup()
+
+import atexit
+atexit.register(cleanup)
+
 
 class GeneralTest():
 
@@ -107,66 +400,110 @@ class GeneralTest():
         fork_under_test = self.fork_name
 
         prestate = {
-            'config' : { # for pyeth run_statetest.py
-                'metropolisBlock' : 2000, # same default as evmlab/genesis.py
-                'eip158Block' : 2000,
-                'eip150Block' : 2000,
-                'eip155Block' : 2000,
-                'homesteadBlock' : 2000,
-            }
+            'config' : pyeth.forkBlocks(fork_under_test), # for pyeth run_statetest.py
         }
-        if fork_under_test == 'Byzantium':
-            prestate['config'] = {
-                'metropolisBlock' : 0,
-                'eip158Block' : 0,
-                'eip150Block' : 0,
-                'eip155Block' : 0,
-                'homesteadBlock' : 0,
-            }
-
-        if fork_under_test == 'Homestead':
-            prestate['config']['homesteadBlock'] = 0
 
         json_data = self.json_data
 
         for test_name in json_data:
-            prestate['env'] = json_data[test_name]['env']
-            prestate['pre'] = json_data[test_name]['pre']
+            # the input of pyeth run_statetest.py, shared by all the single tests
+            test_prestate = dict(prestate, 
+                env = json_data[test_name]['env'], 
+                pre = json_data[test_name]['pre'])
 
             general_tx = json_data[test_name]['transaction']
+
+            # Everything but the transaction and post is the same for all the 
+            # single tests, and is serialized only once
+            shared = json.dumps(dict((k, v) for (k, v) in json_data[test_name].items() 
+                if k not in ('transaction', 'post')))
+            head = '{%s: %s' % (json.dumps(test_name), shared[:-1])
+            if len(shared) > 2:
+                head = head + ', '
+            # identifies the prestate, so pyeth can build it once for all single tests
+            prestate_key = resultcache.contentHash(head)
+
+            batch = None
+            if cfg['BATCH']:
+                posts = json_data[test_name]['post'][fork_under_test]
+                batch = Batch(test_name, json_data[test_name], fork_under_test, len(posts))
             
             tx_i = 0
             for poststate in json_data[test_name]['post'][fork_under_test]:
                 
-                poststate = poststate.copy()
-
-                tx = general_tx.copy()
                 d = poststate['indexes']['data']
                 g = poststate['indexes']['gas']
                 v = poststate['indexes']['value']
-                tx['data'] = [general_tx['data'][d]]
-                tx['gasLimit'] = [general_tx['gasLimit'][g]]
-                tx['value'] = [general_tx['value'][v]]
+                tx = dict(general_tx, 
+                    data = [general_tx['data'][d]], 
+                    gasLimit = [general_tx['gasLimit'][g]],
+                    value = [general_tx['value'][v]])
                 
-                single_test = json_data.copy()
-                poststate['indexes'] =  {'data':0,'gas':0,'value':0}
-                single_test[test_name]['post'] = { fork_under_test: [ poststate ] }
-                single_test[test_name]['transaction'] = tx
+                poststate = dict(poststate, indexes = {'data':0,'gas':0,'value':0})
+                single_test = '%s"transaction": %s, "post": %s}}' % (head, 
+                    json.dumps(tx), json.dumps({ fork_under_test: [ poststate ] }))
  
                 state_test = StateTest()
 
                 state_test.subfolder = self.subfolder
                 state_test.name = test_name
                 state_test.tx_i = tx_i
-                state_test.statetest = single_test
+                state_test.statetest_json = single_test
                 state_test.tx = tx
+                state_test.prestate = test_prestate
+                state_test.prestate_key = prestate_key
                 state_test.tx_dgv = (d,g,v)
+                state_test.batch = batch
 
                 tx_i = tx_i +1
 
 
                 yield state_test
 
+class Batch():
+    """ All the post-states of a test (on the fork under test), executed with a
+    single invocation of each client which supports it. The output of each 
+    client is split into one job per post-state (see `workers.BatchRun`), so 
+    the individual tests are compared just as if they were executed on their own
+    """
+    CLIENTS = ['geth', 'parity']
+
+    def __init__(self, name, test, fork, posts):
+        self.statetest = { name: dict(test, post = { fork: test['post'][fork] }) }
+        self.name = name
+        self.posts = posts
+        self.tmpfile = None
+        self.runs = {}
+
+    def writeToFile(self, batch_id):
+        self.tmpfile = getSpool().file("batch-%s" % batch_id)
+        with open(self.tmpfile, 'w') as outfile:
+            json.dump(self.statetest, outfile)
+
+    def job(self, client_name, starter, test):
+        """ Returns the process info of a post-state, starting the client on 
+        the whole test if it's not running yet """
+        if client_name not in self.runs:
+            if self.tmpfile is None:
+                self.writeToFile(test.id())
+            procinfo = starter(self)
+            timeout = 30 * self.posts
+            if 'job' in procinfo:
+                lines = procinfo['job'].stream(timeout)
+            else:
+                lines = VMUtils.streamProc(procinfo['proc'], output = procinfo['output'], timeout = timeout, kill_cmd = procinfo.get('kill'))
+            self.runs[client_name] = (workers.BatchRun(lines, self.posts), procinfo)
+
+        (run, procinfo) = self.runs[client_name]
+        return {'job': run.jobs[test.tx_i], 'cmd': procinfo['cmd'], 'output': procinfo['output']}
+
+    def close(self):
+        for (run, procinfo) in self.runs.values():
+            run.close()
+        self.runs = {}
+        if self.tmpfile is not None and os.path.exists(self.tmpfile):
+            os.remove(self.tmpfile)
+
 class StateTest():
     """ This class represents a single statetest, with a single post-tx result: one transaction
     executed on one single fork
@@ -176,21 +513,86 @@ class StateTest():
         self.subfolder = None
         self.name = None
         self.tx_i = None
-        self.statetest = None
+        # the test, serialized
+        self.statetest_json = None
         self.tx = None
         self.tx_dgv = None
+        # env, pre and fork config, for pyeth
+        self.prestate = None
+        self.prestate_key = None
         self.canon_traces = []
+        # digests of the canon_traces, if they were read to their end up front
+        self.trace_digests = []
         self.procs = []
         self.traceFiles = []
         self.tmpfile = cfg['SINGLE_TEST_TMP_FILE']
+        self.spooled = False
+        self.started = None
+        # number of post-states in the test file
+        self.posts = 1
+        # the Batch this test is executed in, if any
+        self.batch = None
+        # where cpp finds the test, if not under 'tests_path' (see placeTest)
+        self.testpath = None
+        self.content_hash = None
+        # paths of the files kept for a failure
+        self.artifacts = []
+        # client name -> resources used by its processes
+        self.usage = {}
+        # client name -> TraceDigest, for the clients with cached results
+        self.cached = {}
+        # vm.Signature of the first trace difference, for failures
+        self.signature = None
+        # fraction of the re-runs which reproduced the failure, if re-run
+        self.reproduced = None
+        self.flaky = False
+
+    def spool(self):
+        """ Places the test in its own file in the spool directory, where the 
+        persistent workers can access it """
+        self.tmpfile = getSpool().file(self.id())
+        self.spooled = True
+
+    def placeForCpp(self, root):
+        """ Gives cpp (which does not read the test file, but looks the test up
+        by subfolder and name) a tree of its own under 'root' with the test in it.
+        For tests which are not in 'tests_path' as they are """
+        if 'cpp' in cfg['DO_CLIENTS']:
+            placeTest(root, self.subfolder, self.statetest)
+            self.testpath = root
 
     def id(self):
         return "{:0>4}-{}-{}-{}".format(self.number,self.subfolder,self.name,self.tx_i)
 
+    def key(self):
+        """ Identifies the test in the ledger, independent of its position in the run """
+        return "{}/{}/{}".format(self.subfolder,self.name,self.tx_i)
+
+    @property
+    def statetest(self):
+        return json.loads(self.statetest_json)
+
     def writeToFile(self):
 
+        data = self.statetest_json
+        self.content_hash = resultcache.contentHash(data)
         with open(self.tmpfile, 'w') as outfile:
-            json.dump(self.statetest, outfile)
+            outfile.write(data)
+
+    def cacheKey(self, client_name):
+        """ Returns the result cache key for running this test on a client """
+        return (self.content_hash, resultcache.clientDigest(*getBaseCmd(client_name)), cfg['FORK_CONFIG'])
+
+    def clients(self):
+        """ The clients the test was executed on (or had cached results for) """
+        names = set(client_name for (procinfo, client_name) in self.procs) | set(self.cached)
+        return [c for c in cfg['DO_CLIENTS'] if c in names]
+
+    def outcome(self, passed):
+        """ The ledger outcome of the test """
+        if passed:
+            return runledger.PASS
+        return runledger.FLAKY if self.flaky else runledger.FAIL
 
 
 
@@ -205,6 +607,22 @@ def iterate_tests(path = '/GeneralStateTests/', ignore = []):
                     yield os.path.join(subdir, f)
 
 
+def placeTest(root, subfolder, statetest):
+    """ Writes a test file with a single test where cpp finds it (-t 
+    GeneralStateTests/<subfolder> --singletest <name> --testpath root), along
+    with the (empty) filler testeth expects. Returns the path of the test file """
+    import pathlib
+    name = list(statetest.keys())[0]
+    testfile_dir = os.path.join(root, "GeneralStateTests", subfolder)
+    filler_dir = os.path.join(root, "src", "GeneralStateTestsFiller", subfolder)
+    os.makedirs(testfile_dir, exist_ok = True)
+    os.makedirs(filler_dir, exist_ok = True)
+    test_fullpath = os.path.join(testfile_dir, "%s.json" % name)
+    with open(test_fullpath, "w+") as f:
+        json.dump(statetest, f)
+    pathlib.Path(os.path.join(filler_dir, "%sFiller.json" % name)).touch()
+    return test_fullpath
+
 def dumpJson(obj, dir = None, prefix = None):
     import tempfile
     fd, temp_path = tempfile.mkstemp(prefix = 'randomtest_', suffix=".json", dir = dir)
@@ -244,33 +662,45 @@ def generateTests():
     here = os.path.dirname(os.path.realpath(__file__))
 
     cfg['TESTS_PATH'] = "%s/generatedTests/" % here
-    # cpp needs the tests to be placed according to certain rules... 
-    testfile_dir = "%s/generatedTests/GeneralStateTests/stRandom" % here
-    filler_dir = "%s/generatedTests/src/GeneralStateTestsFiller/stRandom" % here 
-
-    os.makedirs( testfile_dir , exist_ok = True)
-    os.makedirs( filler_dir, exist_ok = True)
-    import pathlib
 
-    counter = 0
-    while True: 
-        test_json =  createRandomStateTest()
+    counter = itertools.count()
+    native = None
+    coverage = None
+    if cfg['GENERATOR'] in ('native', 'coverage'):
+        native = randomtest.StateTestGenerator(cfg['GENERATOR_SEED'], cfg['FORK_CONFIG'])
+    if cfg['GENERATOR'] == 'coverage':
+        # its own executor (and kept state), since it's used from the generator threads. 
+        # Its tests are executed one at a time with those of getPyeth()
+        executor = pyeth.PyethExecutor(local_cfg["py.runner"] or pyeth.DEFAULT_RUNNER)
+        coverage = campaign.Campaign(native, executor, cfg['COVERAGE_CORPUS'], 
+            cfg['COVERAGE_MUTATE'], cfg['GENERATOR_SEED'])
+
+    def produce():
+        index = next(counter)
+        if coverage is not None:
+            test_json = coverage.next()
+        elif native is not None:
+            test_json = native.generate(index)
+        else:
+            test_json = createRandomStateTest()
         if test_json == None: 
-            time.sleep(2)
-            continue
+            return None
 
-        identifier = "%s-%d" %(host_id, counter)
-        test_fullpath = "%s/randomStatetest%s.json" % (testfile_dir, identifier)
-        filler_fullpath = "%s/randomStatetest%sFiller.json" % (filler_dir, identifier)
+        identifier = "%s-%d" %(host_id, index)
         test_json['randomStatetest%s' % identifier] =test_json.pop('randomStatetest', None) 
 
-        
-        with open(test_fullpath, "w+") as f:
-            json.dump(test_json, f)
-            pathlib.Path(filler_fullpath).touch()
+        # cpp needs the tests to be placed according to certain rules... 
+        return placeTest(cfg['TESTS_PATH'], "stRandom", test_json)
 
-        yield test_fullpath
-        counter = counter +1
+    # generation runs in the background, overlapping with the execution
+    pool = workers.ProducerPool(produce, cfg['GENERATORS'], cfg['PREFETCH'], name = "test files")
+    try:
+        yield from pool
+    finally:
+        pool.stop()
+        logger.info(pool.report())
+        if coverage is not None:
+            logger.info(coverage.report())
 
 
 
@@ -350,10 +780,37 @@ SKIP_LIST = [
 
 regex_skip = [skip.replace('*', '') for skip in SKIP_LIST if '*' in skip]
 
-# to resume running after interruptions
-START_I = 0
-
-
+def failedTestIterator(failures):
+    """ Returns an iterator over the tests saved for the given ledger failures """
+    def iterator():
+        number = 0
+        for (key, test_id, artifacts) in failures:
+            testfiles = [a for a in artifacts if a.endswith("-test.json") and os.path.exists(a)]
+            if not testfiles:
+                logger.warning("No saved test file for %s, skipping", test_id)
+                continue
+            with open(testfiles[0]) as json_data:
+                general_test = GeneralTest(json.load(json_data), testfiles[0])
+            (subfolder, name, tx_i) = key.split("/")
+            for state_test in general_test.individual_tests():
+                state_test.number = number
+                state_test.subfolder = subfolder
+                state_test.tx_i = int(tx_i)
+                # the single post-state of the saved test, not that of the original file
+                state_test.placeForCpp(os.path.join(getSpool().path, "cpp", "failure-%d" % number))
+                number = number +1
+                yield state_test
+    return iterator
+
+def skipDone(test_iterator, done):
+    """ Wraps a test iterator, skipping the tests which are already done """
+    def iterator():
+        for test in test_iterator():
+            if test.key() in done:
+                logger.info("skipping test (done): %s" % test.key())
+                continue
+            yield test
+    return iterator
 
 
 def randomTestIterator():
@@ -371,46 +828,110 @@ def randomTestIterator():
             yield state_test
 
 def main():
-    perform_tests(randomTestIterator)
+    (done, failures) = openLedger()
+    test_iterator = randomTestIterator
+    if failures is not None:
+        test_iterator = failedTestIterator(failures)
+    if done:
+        test_iterator = skipDone(test_iterator, done)
+
+    if cfg['CLIENT_QUEUES']:
+        perform_tests_queued(test_iterator)
+    elif cfg['PARALLEL'] > 1:
+        perform_tests_parallel(test_iterator)
+    else:
+        perform_tests(test_iterator)
+    closeLedger()
 
 
-def finishProc(name, processInfo, canonicalizer, fulltrace_filename = None):
-    """ Ends the process, returns the canonical trace and also writes the 
-    full process output to a file, along with the command used to start the process"""
+def traceSteps(name, processInfo, canonicalizer, fulltrace_filename = None):
+    """ Generator of the canonical trace steps of a started process. The full 
+    process output is written to a file while it's being read, along with the 
+    command used to start the process"""
+
+    timeout = processInfo.get('timeout', 45 if name == "py" else 30)
+    if 'job' in processInfo:
+        outp = processInfo['job'].stream(timeout)
+    else:
+        outp = VMUtils.streamProc(processInfo['proc'], output = processInfo['output'], timeout = timeout, kill_cmd = processInfo.get('kill'))
+
+    if fulltrace_filename is None:
+        yield from getHealth().monitor(name, outp, canonicalizer, timeout)
+        return
 
-    process = processInfo['proc']
+    #logging.info("Writing %s full trace to %s" % (name, fulltrace_filename))
+    with open(fulltrace_filename, "w+") as f: 
+        f.write("# command\n")
+        f.write("# %s\n\n" % processInfo['cmd'])
+
+        def tee(lines):
+            for line in lines:
+                f.write(line)
+                f.write("\n")
+                yield line
+
+        yield from getHealth().monitor(name, tee(outp), canonicalizer, timeout)
+
+def traceFileName(test, client_name):
+    return os.path.abspath("%s/%s-%s.trace.log" % (cfg['LOGS_PATH'], test.id(), client_name))
+
+def savedSteps(name, fulltrace_filename):
+    """ The canonical trace steps of a client, read as they are needed from the 
+    full trace written by 'traceSteps' """
+    with open(fulltrace_filename) as f:
+        # without the command header
+        lines = (line.rstrip("\n") for line in itertools.islice(f, 3, None))
+        yield from canonicalizers[name](lines)
+
+def finalState(name, processInfo):
+    """ Ends the process, and returns only the final stateRoot and gasUsed """
+
+    timeout = processInfo.get('timeout', 45 if name == "py" else 30)
+    started = time.time()
+    if 'job' in processInfo:
+        outp = processInfo['job'].stream(timeout)
+    else:
+        outp = VMUtils.streamProc(processInfo['proc'], output = processInfo['output'], timeout = timeout, kill_cmd = processInfo.get('kill'))
+
+    final = VMUtils.finalState(outp)
+    getHealth().record(name, health.outcome(len(final), 'stateRoot' in final, time.time() - started, timeout))
+    return final
+
+def traceDigest(name, processInfo, canonicalizer):
+    """ Ends the process, and returns the rolling digest of its canonical trace """
+
+    return VMUtils.TraceDigest(cfg['DIGEST_INTERVAL']).fold(traceSteps(name, processInfo, canonicalizer))
 
-    extraTime = False
-    if name == "py":
-        extraTime = True
+def readTrace(name, processInfo, canonicalizer, fulltrace_filename):
+    """ Ends the process, writing its full output to a file, and returns the 
+    rolling digest of its canonical trace. The steps are not kept: when the 
+    digests differ, they are read again from the file (see 'savedSteps') """
 
-    outp = VMUtils.finishProc(processInfo['proc'], extraTime, processInfo['output'])
+    digest = VMUtils.TraceDigest(cfg['DIGEST_INTERVAL']).fold(traceSteps(name, processInfo, canonicalizer, fulltrace_filename))
+    logger.info("Processed %s steps for %s", digest.count, name)
+    return digest
 
-    if fulltrace_filename is not None:
-        #logging.info("Writing %s full trace to %s" % (name, fulltrace_filename))
-        with open(fulltrace_filename, "w+") as f: 
-            f.write("# command\n")
-            f.write("# %s\n\n" % processInfo['cmd'])
-            f.write("\n".join(outp))
+def finishProc(name, processInfo, canonicalizer, fulltrace_filename = None):
+    """ Ends the process, returns the canonical trace and also writes the 
+    full process output to a file, along with the command used to start the process"""
 
-    canon_text = [VMUtils.toText(step) for step in canonicalizer(outp)]
-    return canon_text
+    return list(traceSteps(name, processInfo, canonicalizer, fulltrace_filename))
 
 def get_summary(combined_trace, n=20):
-    """Returns (up to) n (default 20) preceding steps before the first diff, and the diff-section
+    """Returns (up to) n (default 20) preceding steps before the first diff, and the diff-section.
+    The combined trace is read as it's needed, e.g. from a file
     """
     from collections import deque
     buf = deque([],n)
-    index = 0
-    for index, line in enumerate(combined_trace):
+    lines = iter(combined_trace)
+    for index, line in enumerate(lines):
         if line.startswith("[!!]"):
             buf.append("\n---- [ %d steps in total before diff ]-------\n\n" % (index))
+            buf.append(line)
+            buf.extend(itertools.islice(lines, 4))
             break
         buf.append(line)
 
-    for i in range(index, min(len(combined_trace), index+5 )):
-        buf.append(combined_trace[i])
-
     return list(buf)
 
 def startGeth(test):
@@ -419,9 +940,19 @@ def startGeth(test):
     mount_testfile = testfile_path + ":" + "/mounted_testfile"
 
     (name, isDocker) = getBaseCmd("geth")
+    if cfg['PERSISTENT_WORKERS']:
+        worker = getWorker("geth", {getSpool().path: "/spool"})
+        if isDocker:
+            container = workers.containerName("geth")
+            cmd = worker.command(["--json", "--nomemory", "statetest", "/spool/%s" % os.path.basename(testfile_path)], container)
+            return {'proc':VMUtils.startProc(cmd ), 'cmd': " ".join(cmd), 'output' : 'stdout', 'kill': worker.killCommand(container)}
+        if worker is not None:
+            return {'job':workers.StdinJob(worker, testfile_path, test.posts), 'cmd': " ".join(worker.cmd), 'output' : 'stderr'}
+
     if isDocker:
-        cmd = ["docker", "run", "--rm", "-t", "-v", mount_testfile, name, "--json", "--nomemory", "statetest", "/mounted_testfile"]
-        return {'proc':VMUtils.startProc(cmd ), 'cmd': " ".join(cmd), 'output' : 'stdout'}
+        container = workers.containerName("geth")
+        cmd = ["docker", "run", "--rm", "--name", container, "-t", "-v", mount_testfile, name, "--json", "--nomemory", "statetest", "/mounted_testfile"]
+        return {'proc':VMUtils.startProc(cmd ), 'cmd': " ".join(cmd), 'output' : 'stdout', 'kill': ["docker", "kill", container]}
     else:
         cmd = [name,"--json", "--nomemory", "statetest", testfile_path]
         return {'proc':VMUtils.startProc(cmd ), 'cmd': " ".join(cmd), 'output' : 'stderr'}
@@ -432,24 +963,42 @@ def startParity(test):
     mount_testfile = testfile_path + ":" + "/mounted_testfile"
 
     (name, isDocker) = getBaseCmd("parity")
-    if isDocker:
-        cmd = ["docker", "run", "--rm", "-t", "-v", mount_testfile, name, "state-test", "/mounted_testfile", "--json"]
+    container = workers.containerName("parity")
+    kill = None
+    if isDocker and cfg['PERSISTENT_WORKERS']:
+        worker = getWorker("parity", {getSpool().path: "/spool"})
+        cmd = worker.command(["state-test", "/spool/%s" % os.path.basename(testfile_path), "--json"], container)
+        kill = worker.killCommand(container)
+    elif isDocker:
+        cmd = ["docker", "run", "--rm", "--name", container, "-t", "-v", mount_testfile, name, "state-test", "/mounted_testfile", "--json"]
+        kill = ["docker", "kill", container]
     else:
         cmd = [name,"state-test", testfile_path, "--json"]
 
 
-    return {'proc':VMUtils.startProc(cmd ), 'cmd': " ".join(cmd), 'output' : 'stdout'}
+    return {'proc':VMUtils.startProc(cmd ), 'cmd': " ".join(cmd), 'output' : 'stdout', 'kill': kill}
 
 def startCpp(test):
 
     [d,g,v] = test.tx_dgv
+    testpath = test.testpath or cfg['TESTS_PATH']
 
 
     (name, isDocker) = getBaseCmd("cpp")
+    container = workers.containerName("cpp")
+    kill = None
     if isDocker:
-        cpp_mount_tests = cfg['TESTS_PATH'] + ":" + "/mounted_tests"
-        cmd = ["docker", "run", "--rm", "-t", "-v", cpp_mount_tests, name
-                ,'-t',"GeneralStateTests/%s" %  test.subfolder
+        cpp_mount_tests = testpath + ":" + "/mounted_tests"
+        # the warm container only has 'tests_path' mounted
+        if cfg['PERSISTENT_WORKERS'] and testpath == cfg['TESTS_PATH']:
+            worker = getWorker("cpp", {cfg['TESTS_PATH']: "/mounted_tests"})
+            base_cmd = worker.command([], container)
+            kill = worker.killCommand(container)
+        else:
+            base_cmd = ["docker", "run", "--rm", "--name", container, "-t", "-v", cpp_mount_tests, name]
+            kill = ["docker", "kill", container]
+        cmd = base_cmd + [
+                '-t',"GeneralStateTests/%s" %  test.subfolder
                 ,'--'
                 ,'--singletest', test.name
                 ,'--jsontrace',"'{ \"disableStorage\":true, \"disableMemory\":true }'"
@@ -464,143 +1013,671 @@ def startCpp(test):
                 ,'--jsontrace',"'{ \"disableStorage\":true, \"disableMemory\":true }'"
                 ,'--singlenet',cfg['FORK_CONFIG']
                 ,'-d',str(d),'-g',str(g), '-v', str(v)
-                ,'--testpath',  cfg['TESTS_PATH']]
+                ,'--testpath',  testpath]
 
 
     if cfg['FORK_CONFIG'] == 'Homestead' or cfg['FORK_CONFIG'] == 'Frontier':
         cmd.extend(['--all']) # cpp requires this for some reason
 
-    return {'proc':VMUtils.startProc(cmd ), 'cmd': " ".join(cmd), 'output' : 'stdout'}
+    return {'proc':VMUtils.startProc(cmd ), 'cmd': " ".join(cmd), 'output' : 'stdout', 'kill': kill}
 
 def startPython(test):
 
-    tx_encoded = json.dumps(test.tx)
+    tx = pyeth.singleTx(test.tx)
+    if local_cfg["py.in_process"] == 'Yes':
+        executor = getPyeth()
+        return {'job': pyeth.PyethJob(executor, test.prestate, tx, test.prestate_key), 'cmd': "in-process %s" % executor.runner, 'output': 'stdout'}
+    if local_cfg["py.server"] == 'Yes':
+        worker = getWorker("py")
+        request = {'id': test.id(), 'prestate_key': test.prestate_key, 'tx': tx}
+        return {'job': workers.StdinJob(worker, None, request = request, prestate = test.prestate), 
+            'cmd': " ".join(worker.cmd), 'output': 'stdout'}
+
+    tx_encoded = json.dumps(tx)
     tx_double_encoded = json.dumps(tx_encoded) # double encode to escape chars for command line
 
-    prestate_path = os.path.abspath(test.prestate_tmpfile)
+    prestate_file = cfg['PRESTATE_TMP_FILE']
+    if threading.current_thread() is not threading.main_thread():
+        # one per thread of the py queue
+        prestate_file = "%s-%s" % (prestate_file, threading.current_thread().name)
+    with open(prestate_file, 'w') as outfile:
+        json.dump(test.prestate, outfile)
+    prestate_path = os.path.abspath(prestate_file)
     mount_flag = prestate_path + ":" + "/mounted_prestate"
-    cmd = ["docker", "run", "--rm", "-t", "-v", mount_flag, cfg['PYETH_DOCKER_NAME'], "run_statetest.py", "/mounted_prestate", tx_double_encoded]
+    (name, isDocker) = getBaseCmd("py")
+    container = workers.containerName("py")
+    cmd = ["docker", "run", "--rm", "--name", container, "-t", "-v", mount_flag, name, "run_statetest.py", "/mounted_prestate", tx_double_encoded]
+
+    return {'proc':VMUtils.startProc(cmd), 'cmd': " ".join(cmd), 'output' : 'stdout', 'kill': ["docker", "kill", container]}
 
-    return {'proc':VMUtils.startProc(cmd), 'cmd': " ".join(cmd), 'output' : 'stdout'}
 
+starters = {'geth': startGeth, 'cpp': startCpp, 'py': startPython, 'parity': startParity}
 
-def start_processes(test):
-    clients = cfg['DO_CLIENTS']
+def start_processes(test, use_cache = True, clients = None):
+    if clients is None:
+        # without the clients which are ejected for now
+        clients = getHealth().admitted(cfg['DO_CLIENTS'])
 
-    starters = {'geth': startGeth, 'cpp': startCpp, 'py': startPython, 'parity': startParity}
+    cache = getResultCache() if use_cache else None
 
     logger.info("Starting processes for %s on test %s" % ( clients, test.name))
     #Start the processes
     for client_name in clients:
         if client_name in starters.keys():
-            procinfo = starters[client_name](test)
+            if cache is not None:
+                cached = cache.get(*test.cacheKey(client_name))
+                if cached is not None:
+                    logger.info("Using cached result for %s on test %s", client_name, test.name)
+                    test.cached[client_name] = cached
+                    continue
+            if test.batch is not None and client_name in Batch.CLIENTS:
+                procinfo = test.batch.job(client_name, starters[client_name], test)
+            else:
+                procinfo = starters[client_name](test)
+                procinfo['timeout'] = clientTimeout(client_name, test)
             test.procs.append( (procinfo, client_name ))        
         else:
             logger.warning("Undefined client %s", client_name)
 
 
 canonicalizers = {
-    "geth" : VMUtils.GethVM.canonicalized, 
-    "cpp"  : VMUtils.CppVM.canonicalized, 
-    "py"   : VMUtils.PyVM.canonicalized, 
-    "parity"  :  VMUtils.ParityVM.canonicalized ,
+    "geth" : VMUtils.GethVM.canonicalSteps, 
+    "cpp"  : VMUtils.CppVM.canonicalSteps, 
+    "py"   : VMUtils.PyVM.canonicalSteps, 
+    "parity"  :  VMUtils.ParityVM.canonicalSteps ,
 }
 
 def end_processes(test):
     # Handle the old processes
     if test is not None:
         for (procinfo, client_name) in test.procs:
-            if procinfo['proc'] is None:
+            if procinfo.get('proc') is None and procinfo.get('job') is None:
                 continue
 
             canonicalizer = canonicalizers[client_name]
-            full_trace_filename = os.path.abspath("%s/%s-%s.trace.log" % (cfg['LOGS_PATH'],test.id(), client_name))
+            full_trace_filename = traceFileName(test, client_name)
             test.traceFiles.append(full_trace_filename)
-            canon_trace = finishProc(client_name, procinfo, canonicalizer, full_trace_filename)
+            if cfg['LOCKSTEP']:
+                # the steps are read (and compared) in processTraces
+                test.canon_traces.append(traceSteps(client_name, procinfo, canonicalizer, full_trace_filename))
+                continue
 
-            test.canon_traces.append(canon_trace)
+            test.trace_digests.append(readTrace(client_name, procinfo, canonicalizer, full_trace_filename))
+            # only read (again) if the digests differ
+            test.canon_traces.append(savedSteps(client_name, full_trace_filename))
+
+
+def abort_processes(test):
+    """ Kills the processes of a test which are still producing output """
+    for (procinfo, client_name) in test.procs:
+        if 'job' in procinfo:
+            procinfo['job'].abort()
+        elif procinfo.get('proc') is not None and procinfo['proc'].returncode is None:
+            # not poll(), which would reap the process before its usage is read
+            if procinfo.get('kill') is not None:
+                # killing the docker client does not stop the evm in the container
+                subprocess.call(procinfo['kill'], stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+            try:
+                os.killpg(procinfo['proc'].pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+def compareRoots(test):
+    """ Phase one of a two-phase run: compare only the final state of the clients """
+    final_states = [finalState(client_name, procinfo) for (procinfo, client_name) in test.procs]
+    (equivalent, output) = VMUtils.compare_final_states(final_states, 
+        [client_name for (procinfo, client_name) in test.procs])
+    if not equivalent:
+        logger.info("stateRoot mismatch on %s:\n%s", test.id(), "\n".join(output))
+    return equivalent
+
+def compareDigests(test):
+    """ Compare the rolling digests of the client traces. Returns (equivalent, start), 
+    where start is the number of steps known to be identical"""
+    procs = dict((client_name, procinfo) for (procinfo, client_name) in test.procs)
+    clients = [c for c in cfg['DO_CLIENTS'] if c in procs or c in test.cached]
+    digests = []
+    for client_name in clients:
+        if client_name in test.cached:
+            digests.append(test.cached[client_name])
+        else:
+            digests.append(traceDigest(client_name, procs[client_name], canonicalizers[client_name]))
+
+    (equivalent, start) = VMUtils.compare_digests(digests)
+    if not equivalent:
+        logger.info("Trace digest mismatch on %s: %s, identical up to step %d", 
+            test.id(), ", ".join(d.digest() for d in digests), start)
+        return (equivalent, start)
+
+    # Only results the clients agree on are cached
+    cache = getResultCache()
+    if cache is not None:
+        for (client_name, digest) in zip(clients, digests):
+            if client_name not in test.cached:
+                cache.put(*test.cacheKey(client_name), client = client_name, trace_digest = digest)
+    return (equivalent, start)
+
+def collectUsage(test):
+    """ Adds the resources used by the (finished) processes of a test to 'test.usage' """
+    for (procinfo, client_name) in test.procs:
+        process = procinfo.get('job') or procinfo.get('proc')
+        usage = getattr(process, 'usage', None)
+        if usage is not None:
+            test.usage[client_name] = usage.plus(test.usage.get(client_name))
+
+def needsSpool():
+    """ Whether tests need their own file, which outlives the next test """
+    return (cfg['PERSISTENT_WORKERS'] or cfg['TWO_PHASE'] or cfg['DIGEST'] or cfg['BATCH'] 
+        or cfg['FLAKY_RERUNS'] > 0)
+
+def finish_test(test):
+    """ Ends the processes of a test and compares the results. Returns True if the
+    clients agree. In two-phase or digest mode, only tests whose stateRoots 
+    (or digests) differ are re-run with full traces """
+    batch = test.batch
+    if batch is not None and test.tx_i == batch.posts - 1:
+        try:
+            return _finish_test(test)
+        finally:
+            batch.close()
+    return _finish_test(test)
+
+def _finish_test(test):
+    skip = 0
+    if cfg['DIGEST'] or cfg['TWO_PHASE']:
+        if cfg['DIGEST']:
+            (equivalent, skip) = compareDigests(test)
+        else:
+            equivalent = compareRoots(test)
+        collectUsage(test)
+        if equivalent:
+            if test.spooled:
+                os.remove(test.tmpfile)
+            return True
+        logger.info("Re-running %s with full traces", test.id())
+        test.procs = []
+        test.cached = {}
+        # on its own, the batch has already moved on
+        test.batch = None
+        start_processes(test, use_cache = False)
+
+    end_processes(test)
+    equivalent = processTraces(test, skip)
+    collectUsage(test)
+    return equivalent
+
+# steps kept before the first difference of the traces, as in the summary
+SUMMARY_STEPS = 20
+
+def processTraces(test, skip = 0):
+    if test is None:
+        return
 
-            logging.info("Processed %s steps for %s on test %s" % (len(canon_trace), client_name, test.name))
+    def divergence(signature):
+        test.signature = signature
 
+    # without the clients which were ejected
+    names = [client_name for (procinfo, client_name) in test.procs]
 
-def processTraces(test):
-    if test is None:
-        return
+    # Process previous traces. Only the steps around the first difference are
+    # kept, the combined trace of a failure is written from the trace files
+    if test.trace_digests and VMUtils.compare_digests(test.trace_digests)[0]:
+        (equivalent, trace_output) = (True, [])
+    elif cfg['LOCKSTEP']:
+        (equivalent, trace_output) = VMUtils.compare_streams(test.canon_traces, names,
+            cfg['LOCKSTEP_TAIL'], lambda: abort_processes(test), skip, divergence, SUMMARY_STEPS)
+    else:
+        (equivalent, trace_output) = VMUtils.compare_traces(test.canon_traces, names, skip, divergence, SUMMARY_STEPS) 
+    for steps in test.canon_traces:
+        if hasattr(steps, 'close'):
+            steps.close()
 
-    # Process previous traces
-    (equivalent, trace_output) = VMUtils.compare_traces(test.canon_traces, cfg['DO_CLIENTS']) 
+    if not equivalent and cfg['FLAKY_RERUNS'] > 0 and test.signature is not None:
+        test.reproduced = reproduce(test)
+        test.flaky = test.reproduced < cfg['FLAKY_MIN_RATE']
+        logger.warning("%s %s reproduced in %d%% of %d re-runs", "Flaky failure" if test.flaky else "Failure",
+            test.id(), round(100 * test.reproduced), cfg['FLAKY_RERUNS'])
 
     if equivalent:
         #delete non-failed traces
         for f in test.traceFiles:
             os.remove(f)
+        if test.spooled:
+            os.remove(test.tmpfile)
+    elif test.flaky or not keepFailure(test):
+        # only counted
+        for f in test.traceFiles:
+            os.remove(f)
+        if test.spooled:
+            os.remove(test.tmpfile)
     else:
         logger.warning("CONSENSUS BUG!!!")
 
         # save the state-test
         statetest_filename = "%s/%s-test.json" %(cfg['LOGS_PATH'], test.id())
         os.rename(test.tmpfile,statetest_filename)
+        test.artifacts = [os.path.abspath(statetest_filename)] + test.traceFiles
 
         # save combined trace
         passfail_log_filename = "%s/FAIL-%s.log.txt" % ( cfg['LOGS_PATH'], test.id())
 
         with open(passfail_log_filename, "w+") as f:
             logger.info("Combined trace: %s" , passfail_log_filename)
-            f.write("\n".join(trace_output))
+            saved = [savedSteps(client_name, traceFileName(test, client_name)) for client_name in names]
+            for line in VMUtils.combined_trace(saved, names, skip):
+                f.write(line)
+                f.write("\n")
+        test.artifacts.append(os.path.abspath(passfail_log_filename))
 
         # save a summary of the trace, with up to 20 steps preceding the first diff
-        trace_summary = get_summary(trace_output)
+        with open(passfail_log_filename) as f:
+            trace_summary = get_summary(line.rstrip("\n") for line in f)
         summary_log_filename = "%s/FAIL-%s.summary.txt" % ( cfg['LOGS_PATH'],test.id())
         with open(summary_log_filename, "w+") as f:
             logger.info("Summary trace: %s" , summary_log_filename)
             f.write("\n".join(trace_summary))
-
-        return equivalent
+        test.artifacts.append(os.path.abspath(summary_log_filename))
+
+    return equivalent
+
+def reproduce(test):
+    """ Re-runs the clients which disagree on a failed test 'flaky_reruns' times, 
+    all at once, and compares each re-run with the saved traces of the other 
+    clients. Returns the fraction of the re-runs with the same signature """
+    names = [client_name for (procinfo, client_name) in test.procs]
+    disagreeing = test.signature.clients.split("+")
+    clients = [c for c in names if c in disagreeing or not os.path.exists(traceFileName(test, c))]
+    logger.info("Re-running %s on %s", ", ".join(clients), test.id())
+
+    reruns = []
+    for i in range(cfg['FLAKY_RERUNS']):
+        # shares the test file and usage of the test
+        rerun = copy.copy(test)
+        rerun.procs = []
+        rerun.cached = {}
+        rerun.batch = None
+        start_processes(rerun, use_cache = False, clients = clients)
+        reruns.append(rerun)
+
+    reproduced = 0
+    for rerun in reruns:
+        procs = dict((client_name, procinfo) for (procinfo, client_name) in rerun.procs)
+        traces = []
+        for client_name in names:
+            if client_name in procs:
+                traces.append(traceSteps(client_name, procs[client_name], canonicalizers[client_name]))
+            else:
+                traces.append(savedSteps(client_name, traceFileName(test, client_name)))
+        signatures = []
+        VMUtils.compare_streams(traces, names, 0, lambda rerun = rerun: abort_processes(rerun), 
+            divergence = signatures.append)
+        collectUsage(rerun)
+        if signatures and signatures[0] == test.signature:
+            reproduced = reproduced + 1
+    return reproduced / len(reruns)
+
+def keepFailure(test):
+    """ Counts a failure in its bucket. Returns whether its artifacts are kept """
+    bucket_store = getBuckets()
+    if bucket_store is None or test.signature is None:
+        return True
+    count = bucket_store.hit(test.signature, test.id())
+    if bucket_store.keepArtifacts(count):
+        logger.warning("Failure %s in bucket %s (#%d)", test.id(), test.signature, count)
+        return True
+    logger.warning("Failure %s in bucket %s (#%d), artifacts not kept", test.id(), test.signature, count)
+    return False
 
 def perform_tests(test_iterator):
 
     pass_count = 0
     fail_count = 0
+    flaky_count = 0
     failures = []
 
     previous_test = None
 
     start_time = time.time()
 
+    def finish(test):
+        nonlocal pass_count, fail_count, flaky_count
+        outcome = test.outcome(finish_test(test))
+        if outcome == runledger.PASS:
+            pass_count = pass_count +1
+        elif outcome == runledger.FLAKY:
+            flaky_count = flaky_count +1
+        else:
+            fail_count = fail_count +1
+            failures.append(test.id())
+        recordTest(test.key(), test.id(), outcome, test.started, time.time() - test.started, 
+            test.artifacts, test.usage, test.reproduced, test.clients())
+
     n = 0
     for test in test_iterator():
         n = n+1
         #Prepare the current test
         logger.info("Test id: %s" % test.id())
+        # the test file must outlive the next test, which is written before 
+        # this one is finished (and saved, or recorded in the ledger)
+        test.spool()
         test.writeToFile()
 
         # Start new procs
+        test.started = time.time()
         start_processes(test)
 
-        # End previous procs
-        traceFiles = end_processes(previous_test)
-
-
-        # Process previous traces
-        if processTraces(previous_test):
-            pass_count = pass_count +1
-        else:
-            fail_count = fail_count +1
+        # End previous procs, and process previous traces
+        if previous_test is not None:
+            finish(previous_test)
 
         # Do some reporting
 
         if n % 10 == 0:
             time_elapsed = time.time() - start_time
-            logger.info("Fails: {}, Pass: {}, #test {} speed: {:f} tests/s".format(
+            logger.info("Fails: {}, Pass: {}, Flaky: {}, #test {} execution speed: {:f} tests/s".format(
                     fail_count, 
                     pass_count, 
-                    (fail_count + pass_count),
-                    (fail_count + pass_count) / time_elapsed
+                    flaky_count,
+                    (fail_count + pass_count + flaky_count),
+                    (fail_count + pass_count + flaky_count) / time_elapsed
                 ))
-            break
 
         previous_test = test
 
+    if previous_test is not None:
+        finish(previous_test)
+    reportUsage()
+    reportHealth()
+    reportBuckets()
+
+    return (n, len(failures), pass_count, failures)
+
+def init_pool_worker(counter):
+    """ Sets up a process of the test pool: each one gets its own temp files, 
+    log prefix and set of persistent client workers """
+    import multiprocessing.util
+    with counter.get_lock():
+        counter.value += 1
+        index = counter.value
+
+    cfg['WORKER_NAME'] = "w%d" % index
+    cfg['PRESTATE_TMP_FILE'] = "%s-%s" % (cfg['PRESTATE_TMP_FILE'], cfg['WORKER_NAME'])
+    cfg['SINGLE_TEST_TMP_FILE'] = "%s-%s" % (cfg['SINGLE_TEST_TMP_FILE'], cfg['WORKER_NAME'])
+    ch.setFormatter(logging.Formatter('%(asctime)s - {} - %(levelname)s - %(message)s'.format(cfg['WORKER_NAME'])))
+
+    # pool processes don't run atexit handlers
+    multiprocessing.util.Finalize(None, stopWorkers, exitpriority = 10)
+    multiprocessing.util.Finalize(None, closeResultCache, exitpriority = 10)
+    multiprocessing.util.Finalize(None, closeBuckets, exitpriority = 10)
+    multiprocessing.util.Finalize(None, reportHealth, exitpriority = 20)
+    multiprocessing.util.Finalize(None, closeHealth, exitpriority = 20)
+
+def run_test(test):
+    """ Executes a single test in a process of the test pool. 
+    Returns (worker name, test key, test id, outcome, start time, seconds, artifacts, usage, 
+    reproduced, clients)"""
+    start = time.time()
+    logger.info("Test id: %s" % test.id())
+    if needsSpool():
+        test.spool()
+    else:
+        test.tmpfile = cfg['SINGLE_TEST_TMP_FILE']
+    test.writeToFile()
+    start_processes(test)
+    outcome = test.outcome(finish_test(test))
+    return (cfg['WORKER_NAME'], test.key(), test.id(), outcome, start, time.time() - start, 
+        test.artifacts, test.usage, test.reproduced, test.clients())
+
+def run_tests(tests):
+    """ Executes a group of tests (e.g. the post-states of a batch) in a process 
+    of the test pool. Returns a list of the results of 'run_test'"""
+    return [run_test(test) for test in tests]
+
+minimize_counter = itertools.count()
+
+def signatureOf(statetest):
+    """ Executes a state test with a single post-state (as a dict) on all clients, 
+    without keeping any artifacts. Returns the `vm.Signature` of the first trace
+    difference, or None if the clients agree. Used by the minimizer """
+    general_test = GeneralTest(statetest, os.path.join("minimize-%d" % os.getpid(), "test.json"))
+    test = next(general_test.individual_tests())
+    test.number = next(minimize_counter)
+    test.batch = None
+    test.spool()
+    test.writeToFile()
+    test.placeForCpp(os.path.join(getSpool().path, "cpp"))
+    start_processes(test, use_cache = False)
+    traces = [traceSteps(client_name, procinfo, canonicalizers[client_name]) 
+        for (procinfo, client_name) in test.procs]
+    signatures = []
+    VMUtils.compare_streams(traces, [client_name for (procinfo, client_name) in test.procs], 
+        0, lambda: abort_processes(test), divergence = signatures.append)
+    os.remove(test.tmpfile)
+    return signatures[0] if signatures else None
+
+probe_counter = itertools.count()
+
+def probeClient(client_name):
+    """ Executes a simple test on a client which was ejected (from the thread 
+    probing it). Returns whether the client produced a complete trace """
+    general_test = GeneralTest(randomtest.simpleTest(cfg['FORK_CONFIG']), 
+        os.path.join("probe-%s" % client_name, "test.json"))
+    test = next(general_test.individual_tests())
+    test.number = next(probe_counter)
+    test.batch = None
+    test.spool()
+    test.writeToFile()
+    test.placeForCpp(os.path.join(getSpool().path, "cpp"))
+    steps = []
+    try:
+        start_processes(test, use_cache = False, clients = [client_name])
+        for (procinfo, name) in test.procs:
+            steps = list(traceSteps(name, procinfo, canonicalizers[name]))
+    finally:
+        os.remove(test.tmpfile)
+    return len(steps) > 0 and isinstance(steps[-1], VMUtils.StateRoot)
+
+def perform_tests_parallel(test_iterator, num_workers = None, inflight = None):
+    """ Runs the tests on a pool of processes, with at most 'inflight' tests 
+    submitted but not yet finished. The tests of a batch are submitted (and 
+    counted) together, since they share the client processes. The results are
+    recorded on this thread: the ledger connection must not be used from the 
+    thread running the pool callbacks"""
+    import multiprocessing, threading, queue
+
+    if num_workers is None:
+        num_workers = cfg['PARALLEL']
+    if inflight is None:
+        inflight = cfg['INFLIGHT']
+
+    pass_count = 0
+    fail_count = 0
+    flaky_count = 0
+    failures = []
+    per_worker = collections.Counter()
+    window = threading.BoundedSemaphore(max(inflight, num_workers))
+    # (results, None) or (None, (tests, exception)), from the pool callbacks
+    finished = queue.Queue()
+
+    start_time = time.time()
+
+    def report():
+        time_elapsed = time.time() - start_time
+        logger.info("Fails: {}, Pass: {}, Flaky: {}, #test {} execution speed: {:f} tests/s, per worker: {}".format(
+                fail_count, 
+                pass_count, 
+                flaky_count,
+                (fail_count + pass_count + flaky_count),
+                (fail_count + pass_count + flaky_count) / time_elapsed,
+                ", ".join("%s:%d" % (w, c) for (w, c) in sorted(per_worker.items()))
+            ))
+
+    def done(results):
+        finished.put((results, None))
+        window.release()
+
+    def error(tests, e):
+        finished.put((None, (tests, e)))
+        window.release()
+
+    def record(results):
+        nonlocal pass_count, fail_count, flaky_count
+        for (worker_name, test_key, test_id, outcome, started, seconds, artifacts, usage, 
+                reproduced, clients) in results:
+            per_worker[worker_name] += 1
+            if outcome == runledger.PASS:
+                pass_count = pass_count +1
+            elif outcome == runledger.FLAKY:
+                flaky_count = flaky_count +1
+            else:
+                fail_count = fail_count +1
+                failures.append(test_id)
+            recordTest(test_key, test_id, outcome, started, seconds, artifacts, usage, reproduced, clients)
+            if (pass_count + fail_count + flaky_count) % 10 == 0:
+                report()
+
+    def recordError(tests, e):
+        nonlocal fail_count
+        logger.warning("Exception running test %s: %s", tests[0].id(), e)
+        for test in tests:
+            fail_count = fail_count +1
+            recordTest(test.key(), test.id(), runledger.ERROR, None, None)
+
+    def drain():
+        """ Records the tests finished so far """
+        while True:
+            try:
+                (results, failed) = finished.get(block = False)
+            except queue.Empty:
+                return
+            if results is not None:
+                record(results)
+            else:
+                recordError(*failed)
+
+    def submit(tests):
+        window.acquire()
+        drain()
+        pool.apply_async(run_tests, (tests,), callback = done, 
+            error_callback = lambda e, tests = tests: error(tests, e))
+
+    if needsSpool():
+        # create it before forking, so all pool processes share it
+        getSpool()
+
+    pool = None
+    n = 0
+    group = []
+    for test in test_iterator():
+        if pool is None:
+            # Started lazily, since the test iterator may change the config
+            counter = multiprocessing.Value('i', 0)
+            pool = multiprocessing.Pool(num_workers, init_pool_worker, (counter,))
+        n = n+1
+        if group and (test.batch is None or test.batch is not group[0].batch):
+            submit(group)
+            group = []
+        group.append(test)
+
+    if group:
+        submit(group)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    drain()
+    report()
+    reportUsage()
+    reportHealth()
+    reportBuckets()
+
+    return (n, len(failures), pass_count, failures)
+
+def runClient(client_name, test):
+    """ Executes a test on a single client, on a thread of its queue. Returns 
+    (process info, digest of the canonical trace) """
+    procinfo = starters[client_name](test)
+    procinfo['timeout'] = clientTimeout(client_name, test)
+    digest = readTrace(client_name, procinfo, canonicalizers[client_name], traceFileName(test, client_name))
+    return (procinfo, digest)
+
+def perform_tests_queued(test_iterator):
+    """ Executes the tests with a queue per client (see `workers.ClientQueues`), 
+    served by '<client>.workers' threads. Each test is compared on this thread 
+    as soon as all its clients are done, so the fast clients keep going instead
+    of waiting for the slow ones on every test. The tests are always compared
+    with full traces (no batch, two-phase, digest or result cache) """
+    inflight = max(cfg['INFLIGHT'], 2 * max(cfg['QUEUE_THREADS'].values()))
+    queues = workers.ClientQueues(runClient, cfg['QUEUE_THREADS'], inflight)
+
+    pass_count = 0
+    fail_count = 0
+    flaky_count = 0
+    failures = []
+
+    start_time = time.time()
+
+    def report():
+        time_elapsed = time.time() - start_time
+        logger.info("Fails: {}, Pass: {}, Flaky: {}, #test {} execution speed: {:f} tests/s, queued: {}".format(
+                fail_count, 
+                pass_count, 
+                flaky_count,
+                (fail_count + pass_count + flaky_count),
+                (fail_count + pass_count + flaky_count) / time_elapsed,
+                ", ".join("%s:%d" % (c, n) for (c, n) in sorted(queues.backlog().items()))
+            ))
+
+    def finish(test, results):
+        nonlocal pass_count, fail_count, flaky_count
+        for client_name in cfg['DO_CLIENTS']:
+            if results.get(client_name) is not None:
+                (procinfo, digest) = results[client_name]
+                test.procs.append((procinfo, client_name))
+                test.trace_digests.append(digest)
+                test.canon_traces.append(savedSteps(client_name, traceFileName(test, client_name)))
+                test.traceFiles.append(traceFileName(test, client_name))
+        collectUsage(test)
+        if None in results.values():
+            # a client raised
+            for f in test.traceFiles:
+                os.remove(f)
+            os.remove(test.tmpfile)
+            outcome = runledger.ERROR
+        else:
+            outcome = test.outcome(processTraces(test))
+        if outcome == runledger.PASS:
+            pass_count = pass_count +1
+        elif outcome == runledger.FLAKY:
+            flaky_count = flaky_count +1
+        else:
+            fail_count = fail_count +1
+            failures.append(test.id())
+        recordTest(test.key(), test.id(), outcome, test.started, time.time() - test.started, 
+            test.artifacts, test.usage, test.reproduced, test.clients())
+        if (pass_count + fail_count + flaky_count) % 10 == 0:
+            report()
+
+    n = 0
+    for test in test_iterator():
+        n = n+1
+        logger.info("Test id: %s" % test.id())
+        # the test file is read by the clients at different times
+        test.batch = None
+        test.spool()
+        test.writeToFile()
+        test.started = time.time()
+        queues.submit(test.id(), test, getHealth().admitted(cfg['DO_CLIENTS']))
+        for (done, results) in queues.results():
+            finish(done, results)
+
+    for (done, results) in queues.results(block = True):
+        finish(done, results)
+    queues.stop()
+    report()
+    reportUsage()
+    reportHealth()
+    reportBuckets()
 
     return (n, len(failures), pass_count, failures)
 